@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# License: BSD 3 clause
+'''
+Benchmark dump_gitlab_json.py and gitlab_to_stash.py against a local stand-in
+for the GitLab and Stash APIs, so that their throughput can be measured
+without touching a production server.
+
+The stand-in serves a synthetic dataset of configurable size, with optional
+artificial latency on every request. GitLab repositories are all served from
+one local template repository, and Stash repositories are created as local
+bare repositories, so gitlab_to_stash.py can run without SSH access.
+'''
+
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+__version__ = '0.1.0'
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The most results GitLab will return in a single page
+MAX_PER_PAGE = 100
+
+
+class FakeDataset(object):
+    '''
+    Synthetic GitLab data. Everything is generated on demand from ids, so
+    large datasets don't need to be held in memory.
+    '''
+
+    def __init__(self, num_projects, issues_per_project, notes_per_issue,
+                 num_users, repo_url, repo_size=0):
+        self.num_projects = num_projects
+        self.issues_per_project = issues_per_project
+        self.notes_per_issue = notes_per_issue
+        self.num_users = num_users
+        self.repo_url = repo_url
+        self.repo_size = repo_size
+
+    def username(self, user_id):
+        return 'user{}'.format(user_id % self.num_users)
+
+    def user_ref(self, user_id):
+        return {'id': user_id % self.num_users,
+                'username': self.username(user_id)}
+
+    def user(self, user_id):
+        return {'id': user_id, 'username': self.username(user_id),
+                'name': 'User {}'.format(user_id),
+                'email': 'user{}@example.com'.format(user_id),
+                'state': 'blocked' if user_id % 10 == 9 else 'active'}
+
+    def project(self, project_id, statistics=False):
+        name = 'Project {}'.format(project_id)
+        namespace = 'Group {}'.format(project_id % 10)
+        project = {'id': project_id, 'name': name,
+                   'name_with_namespace': '{} / {}'.format(namespace, name),
+                   'path_with_namespace': 'group{}/project{}'.format(
+                       project_id % 10, project_id),
+                   'namespace': {'name': namespace},
+                   'description': 'Benchmark project @{} with a [link]'
+                                  '(http://example.com) :+1:'.format(
+                                      self.username(project_id)),
+                   'issues_enabled': True,
+                   'ssh_url_to_repo': self.repo_url,
+                   'web_url': 'http://gitlab.example.com/group{}/project{}'
+                              .format(project_id % 10, project_id),
+                   'last_activity_at': '2016-01-01T00:00:00.000Z'}
+        if statistics:
+            project['statistics'] = {'repository_size': self.repo_size}
+        return project
+
+    def issue(self, project_id, iid):
+        issue_id = project_id * self.issues_per_project + iid
+        return {'id': issue_id, 'iid': iid, 'project_id': project_id,
+                'title': 'Issue {}'.format(iid),
+                'description': 'Something is broken, @{}.\n```python\n'
+                               'print("@nobody")\n```\nSee [docs]'
+                               '(http://example.com/{}).'.format(
+                                   self.username(issue_id), iid),
+                'state': 'closed' if iid % 3 == 0 else 'opened',
+                'labels': ['bug'] if iid % 2 else [],
+                'author': self.user_ref(issue_id),
+                'assignee': self.user_ref(issue_id + 1) if iid % 4 else None,
+                'created_at': '2015-01-01T00:00:00.000Z',
+                'updated_at': '2016-{:02d}-01T00:00:00.000Z'.format(
+                    iid % 12 + 1)}
+
+    def note(self, issue_id, note_num):
+        note_id = issue_id * self.notes_per_issue + note_num
+        return {'id': note_id,
+                'body': 'Comment {} from @{} :-1:'.format(
+                    note_num, self.username(note_id)),
+                'author': self.user_ref(note_id),
+                'created_at': '2016-01-01T00:00:00.000Z'}
+
+
+class FakeAPIServer(ThreadingHTTPServer):
+    '''
+    HTTP server that stands in for the GitLab v3 and Stash REST endpoints used
+    by the migration scripts, and counts the requests it receives.
+    '''
+    daemon_threads = True
+
+    def __init__(self, dataset, stash_dir, latency=0.0, error_rate=0.0):
+        super(FakeAPIServer, self).__init__(('127.0.0.1', 0), FakeAPIHandler)
+        self.dataset = dataset
+        self.stash_dir = stash_dir
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.request_counts = Counter()
+        self.stash_projects = {}
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] += 1
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    ''' Request handler for :class:`FakeAPIServer`. '''
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so without this every response
+    # on a kept-alive connection would be held up by Nagle's algorithm.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, obj, status=200, headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_gitlab_page(self, total, make_item, query):
+        ''' Send one page of a GitLab listing, with pagination headers. '''
+        page = int(query.get('page', ['1'])[0])
+        per_page = min(int(query.get('per_page', ['20'])[0]), MAX_PER_PAGE)
+        total_pages = max(1, -(-total // per_page))
+        start = (page - 1) * per_page
+        items = [make_item(i) for i in range(start, min(start + per_page,
+                                                        total))]
+        headers = {'X-Total': total, 'X-Total-Pages': total_pages,
+                   'X-Per-Page': per_page, 'X-Page': page,
+                   'X-Next-Page': page + 1 if page < total_pages else ''}
+        self._send_json(items, headers=headers)
+
+    def _send_stash_page(self, values, query):
+        ''' Send one page of a Stash listing. '''
+        start = int(query.get('start', ['0'])[0])
+        limit = int(query.get('limit', ['25'])[0])
+        page_values = values[start:start + limit]
+        is_last_page = start + limit >= len(values)
+        self._send_json({'values': page_values, 'size': len(page_values),
+                         'start': start, 'limit': limit,
+                         'isLastPage': is_last_page,
+                         'nextPageStart': (None if is_last_page else
+                                           start + limit)})
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_HEAD(self):
+        self.server.count('stash_head')
+        self._send_json({})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        server = self.server
+        dataset = server.dataset
+        parsed = urlparse(self.path)
+        path = parsed.path.rstrip('/')
+        query = parse_qs(parsed.query)
+        if server.latency:
+            time.sleep(server.latency)
+        if path.startswith('/api/v3/') and server.error_rate:
+            with server.lock:
+                fail = server.random.random() < server.error_rate
+            if fail:
+                server.count('injected_errors')
+                self._send_json({'message': '503 Service Unavailable'},
+                                status=503)
+                return
+
+        # GitLab
+        match = re.match(r'/api/v3/projects/(\d+)/issues/(\d+)/notes$', path)
+        if match:
+            server.count('getissuewallnotes')
+            issue_id = int(match.group(2))
+            self._send_gitlab_page(
+                dataset.notes_per_issue,
+                lambda i: dataset.note(issue_id, i), query)
+            return
+        match = re.match(r'/api/v3/projects/(\d+)/issues$', path)
+        if match:
+            server.count('getprojectissues')
+            project_id = int(match.group(1))
+            self._send_gitlab_page(
+                dataset.issues_per_project,
+                lambda i: dataset.issue(project_id, i + 1), query)
+            return
+        match = re.match(r'/api/v3/projects/(\d+)$', path)
+        if match:
+            server.count('getproject')
+            self._send_json(dataset.project(int(match.group(1)),
+                                            statistics='statistics' in query))
+            return
+        if path == '/api/v3/projects/all':
+            server.count('getprojectsall')
+            self._send_gitlab_page(
+                dataset.num_projects,
+                lambda i: dataset.project(i + 1,
+                                          statistics='statistics' in query),
+                query)
+            return
+        match = re.match(r'/api/v3/users/(\d+)$', path)
+        if match:
+            server.count('getuser')
+            self._send_json(dataset.user(int(match.group(1))))
+            return
+        if path == '/api/v3/users':
+            server.count('getusers')
+            if 'username' in query or 'search' in query:
+                wanted = (query.get('username') or query.get('search'))[0]
+                users = [dataset.user(int(wanted[len('user'):]))] if (
+                    wanted.startswith('user') and wanted[4:].isdigit() and
+                    int(wanted[4:]) < dataset.num_users) else []
+                self._send_json(users)
+            else:
+                self._send_gitlab_page(dataset.num_users, dataset.user, query)
+            return
+        if path == '/api/v3/session':
+            server.count('session')
+            self._send_json({'private_token': 'benchmark'}, status=201)
+            return
+
+        # Stash
+        if path == '/rest/api/1.0/projects':
+            server.count('stash_projects')
+            with server.lock:
+                if method == 'POST':
+                    data = self._read_json()
+                    server.stash_projects[data['key']] = {
+                        'key': data['key'], 'name': data['name'], 'repos': {}}
+                    self._send_json({'key': data['key'],
+                                     'name': data['name']}, status=201)
+                else:
+                    values = [{'key': proj['key'], 'name': proj['name']}
+                              for proj in server.stash_projects.values()]
+                    self._send_stash_page(values, query)
+            return
+        match = re.match(r'/rest/api/1.0/projects/([^/]+)/repos(?:/([^/]+))?$',
+                         path)
+        if match:
+            server.count('stash_repos')
+            key, slug = match.groups()
+            with server.lock:
+                repos = server.stash_projects[key]['repos']
+                if method == 'POST':
+                    name = self._read_json()['name']
+                    slug = re.sub(r'[^a-z0-9_.-]', '-', name.lower())
+                    repo_path = os.path.join(server.stash_dir, key,
+                                             slug + '.git')
+                    subprocess.check_call(['git', 'init', '--quiet',
+                                           '--bare', repo_path])
+                    repos[slug] = {'name': name, 'slug': slug,
+                                   'links': {'clone': [{'name': 'ssh',
+                                                        'href': repo_path}]}}
+                    self._send_json(repos[slug], status=201)
+                elif slug is not None:
+                    self._send_json(repos[slug])
+                else:
+                    self._send_stash_page(list(repos.values()), query)
+            return
+
+        server.count('not_found')
+        self._send_json({'message': '404 Not Found'}, status=404)
+
+
+def make_template_repo(path, num_commits):
+    '''
+    Create the bare repository that every fake GitLab project is cloned from.
+
+    :returns: The size of the repository in bytes.
+    '''
+    work_dir = path + '.work'
+    subprocess.check_call(['git', 'init', '--quiet', work_dir])
+    for commit_num in range(num_commits):
+        with open(os.path.join(work_dir, 'file.txt'), 'w') as work_file:
+            print(commit_num, file=work_file)
+        subprocess.check_call(['git', 'add', 'file.txt'], cwd=work_dir)
+        subprocess.check_call(['git', '-c', 'user.name=Benchmark',
+                               '-c', 'user.email=benchmark@example.com',
+                               'commit', '--quiet', '-m',
+                               'Commit {}'.format(commit_num)], cwd=work_dir)
+    subprocess.check_call(['git', 'clone', '--quiet', '--bare', work_dir,
+                           path])
+    return sum(os.path.getsize(os.path.join(dir_path, file_name))
+               for dir_path, _, file_names in os.walk(path)
+               for file_name in file_names)
+
+
+def run_target(script, script_args, verbose=False):
+    '''
+    Run one of the migration scripts in a child process.
+
+    :returns: Tuple of the wall time in seconds and the peak RSS of the child
+              process in megabytes.
+    '''
+    output = None if verbose else subprocess.DEVNULL
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable,
+                                os.path.join(SCRIPT_DIR, script)] +
+                               script_args,
+                               stdin=subprocess.DEVNULL, stdout=output,
+                               stderr=output)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    # Keep Popen from trying to reap the process again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, script)
+    # ru_maxrss is in kilobytes on Linux
+    return wall_time, rusage.ru_maxrss / 1024
+
+
+def main(argv=None):
+    '''
+    Process the command line arguments and run the benchmarks.
+
+    :param argv: List of arguments, as if specified on the command-line.
+                 If None, ``sys.argv[1:]`` is used instead.
+    :type argv: list of str
+    '''
+    # Get command line arguments
+    parser = argparse.ArgumentParser(
+        description="Benchmark the migration scripts against a local stand-in \
+                     for GitLab and Stash.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        conflict_handler='resolve')
+    parser.add_argument('-b', '--benchmarks',
+                        help='Which scripts to benchmark.',
+                        nargs='+', choices=['dump', 'stash'],
+                        default=['dump', 'stash'])
+    parser.add_argument('-c', '--commits',
+                        help='Number of commits in each GitLab repository.',
+                        type=int, default=10)
+    parser.add_argument('-d', '--dump_args',
+                        help='Extra arguments to pass to dump_gitlab_json.py, \
+                              as a single string.',
+                        default='')
+    parser.add_argument('-e', '--error_rate',
+                        help='Fraction of GitLab requests to answer with a \
+                              503 error, to exercise retrying.',
+                        type=float, default=0)
+    parser.add_argument('-i', '--issues',
+                        help='Number of issues in each GitLab project.',
+                        type=int, default=20)
+    parser.add_argument('-l', '--latency',
+                        help='Milliseconds to wait before answering every \
+                              request.',
+                        type=float, default=0)
+    parser.add_argument('-n', '--notes',
+                        help='Number of notes on each GitLab issue.',
+                        type=int, default=3)
+    parser.add_argument('-o', '--output',
+                        help='File to also write the results to as JSON.')
+    parser.add_argument('-p', '--projects',
+                        help='Number of GitLab projects.',
+                        type=int, default=50)
+    parser.add_argument('-s', '--stash_args',
+                        help='Extra arguments to pass to gitlab_to_stash.py, \
+                              as a single string.',
+                        default='')
+    parser.add_argument('-u', '--users',
+                        help='Number of GitLab users.',
+                        type=int, default=200)
+    parser.add_argument('-v', '--verbose',
+                        help='Show the output of the benchmarked scripts.',
+                        action='store_true')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo_url = os.path.join(temp_dir, 'template.git')
+        repo_size = make_template_repo(repo_url, args.commits)
+        dataset = FakeDataset(args.projects, args.issues, args.notes,
+                              args.users, repo_url, repo_size=repo_size)
+        server = FakeAPIServer(dataset, os.path.join(temp_dir, 'stash'),
+                               latency=args.latency / 1000,
+                               error_rate=args.error_rate)
+        server_thread = threading.Thread(target=server.serve_forever,
+                                         daemon=True)
+        server_thread.start()
+        print('Serving {} projects with {} issues each at {}'.format(
+            args.projects, args.issues, server.url), file=sys.stderr)
+
+        targets = []
+        if 'dump' in args.benchmarks:
+            targets.append(('dump_gitlab_json.py',
+                            [server.url, '-t', 'benchmark',
+                             '-o', os.devnull] + args.dump_args.split(),
+                            args.projects * args.issues, 'issues'))
+        if 'stash' in args.benchmarks:
+            targets.append(('gitlab_to_stash.py',
+                            [server.url, server.url, '-t', 'benchmark',
+                             '-u', 'benchmark', '-p', 'benchmark'] +
+                            args.stash_args.split(),
+                            args.projects, 'repos'))
+
+        for script, script_args, num_items, item_name in targets:
+            with server.lock:
+                server.request_counts.clear()
+            print('Running {}...'.format(script), file=sys.stderr)
+            wall_time, peak_rss = run_target(script, script_args,
+                                             verbose=args.verbose)
+            with server.lock:
+                request_counts = dict(server.request_counts)
+            results.append({'script': script,
+                            'wall_time': wall_time,
+                            'requests': sum(request_counts.values()),
+                            'requests_by_endpoint': request_counts,
+                            'peak_rss_mb': peak_rss,
+                            item_name: num_items,
+                            item_name + '_per_sec': num_items / wall_time})
+        server.shutdown()
+
+    print('{:<22}{:>10}{:>10}{:>14}{:>16}'.format('script', 'wall (s)',
+                                                  'requests', 'peak RSS (MB)',
+                                                  'items/sec'))
+    for result in results:
+        item_name = 'issues' if 'issues' in result else 'repos'
+        print('{:<22}{:>10.2f}{:>10}{:>14.1f}{:>12.1f} {}'.format(
+            result['script'], result['wall_time'], result['requests'],
+            result['peak_rss_mb'], result[item_name + '_per_sec'],
+            item_name))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
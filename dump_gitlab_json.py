@@ -10,67 +10,1154 @@ Export all users/issues from GitLab to JIRA JSON format.
 
 import argparse
 import getpass
+import hashlib
+import heapq
 import json
 import logging
+import math
+import os
 import re
+import shutil
+import sqlite3
 import sys
-from collections import defaultdict
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
-from functools import partial
-from io import StringIO
+from functools import lru_cache, partial
+from operator import itemgetter
+from pathlib import Path
+from urllib.parse import quote, unquote
 
 from gitlab import Gitlab as GitLab
 from dateutil.parser import parse as parsedate
 
+from gitlab_client import (MAX_PER_PAGE, GitLabAPIError, GitLabClient,
+                           gen_all_results, imap_ordered)
+from metrics import Metrics, ProgressLine
+from project_catalog import (count_projects, list_projects,
+                             make_project_key)
+
 __version__ = '0.1.0'
 
+EPOCH = datetime(1970, 1, 1)
+
+# Usernames that should be converted to JIRA user links
+USERNAME_PATTERN = r'@(?P<username>[a-zA-Z0-9]+)(?P<end>\b|_$)'
+USERNAME_RE = re.compile(USERNAME_PATTERN)
+# Everything md_to_wiki converts besides emoji. Code blocks start with a line
+# ending in a fence and run until the next line ending in a bare fence (or the
+# end of the document), and are matched as a whole so that their contents are
+# skipped. Links include the ! that makes them images, so that links to
+# attached files can be turned into attachment links.
+MARKDOWN_RE = re.compile(r'(?P<fence>```(?P<lang>[a-z]+)?$)'
+                         r'(?P<code>[\s\S]*?\n.*?```$|[\s\S]*)'
+                         r'|(?P<image>!)?'
+                         r'\[(?P<link_text>[^\]\n]+)\]\((?P<url>[^\)\n]+)\)'
+                         r'|' + USERNAME_PATTERN, re.MULTILINE)
+# Markdown links to files uploaded to GitLab, which are relative to the URL of
+# the project
+UPLOAD_RE = re.compile(r'\]\((/uploads/[^\)\s]+)\)')
+
 
 def get_datetime(date_str):
     ''' Turns a YYYY-MM-DD string into a datetime object '''
     return datetime.strptime(date_str, '%Y-%m-%d')
 
 
-def gen_all_results(method, *args, per_page=20, **kwargs):
+def get_shard(shard_str):
+    ''' Turns an i/N string into a (shard index, number of shards) tuple '''
+    try:
+        index, count = (int(part) for part in shard_str.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, got ' +
+                                         repr(shard_str))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('shard index must be between 0 and '
+                                         'N - 1, got ' + repr(shard_str))
+    return index, count
+
+
+def read_high_water_mark(path):
+    '''
+    Read the timestamp saved by a previous run with ``--since_last_run``.
+
+    :returns: A naive UTC datetime, or None if there was no previous run.
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as state_file:
+        return parsedate(json.load(state_file)['last_run'])
+
+
+def write_json_atomic(path, obj):
+    '''
+    Write ``obj`` to ``path`` as JSON such that the file either contains the
+    complete new contents or the old ones, even if we are killed midway.
+    '''
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(obj, json_file)
+    os.replace(temp_path, path)
+
+
+def write_high_water_mark(path, timestamp):
+    '''
+    Save the time a successful run started, so the next run with
+    ``--since_last_run`` only exports what changed after it.
+    '''
+    write_json_atomic(path, {'last_run': timestamp.isoformat()})
+
+
+class JiraJSONWriter(object):
+    '''
+    Writes the JIRA importer JSON document incrementally, so that each project
+    can be written out as soon as it is built instead of holding the whole
+    export in memory. The result is identical to dumping a dictionary with
+    ``projects`` and ``users`` lists (in that order) all at once, where a
+    list that would be empty is left out.
+    '''
+
+    def __init__(self, output, indent=4):
+        '''
+        :param output: File-like object to write the document to.
+        :param indent: Number of spaces to indent by, or None to write compact
+                       JSON.
+        '''
+        self.output = output
+        self.indent = indent
+        self._section = None
+
+    def _newline(self, level):
+        if self.indent is None:
+            return ''
+        return '\n' + ' ' * (self.indent * level)
+
+    def _encode(self, obj):
+        if self.indent is None:
+            return json.dumps(obj, separators=(',', ':'))
+        return json.dumps(obj, indent=self.indent).replace('\n',
+                                                           self._newline(2))
+
+    def _write_item(self, section, item):
+        if section == self._section:
+            self.output.write(',')
+        else:
+            if self._section is None:
+                self.output.write('{')
+            else:
+                self.output.write(self._newline(1) + '],')
+            self.output.write(self._newline(1) + json.dumps(section) +
+                              (':' if self.indent is None else ': ') + '[')
+            self._section = section
+        self.output.write(self._newline(2) + self._encode(item))
+
+    def write_project(self, jira_project):
+        ''' Write a finished project to the output and flush it. '''
+        self._write_item('projects', jira_project)
+        self.output.flush()
+
+    def write_user(self, jira_user):
+        ''' Write a user to the output. Must come after all projects. '''
+        self._write_item('users', jira_user)
+
+    def close(self):
+        ''' Finish the document. '''
+        if self._section is None:
+            self.output.write('{}\n')
+        else:
+            self.output.write(self._newline(1) + ']' + self._newline(0) +
+                              '}\n')
+        self.output.flush()
+
+
+class ShardWriter(object):
+    '''
+    Writes the projects exported by one shard (see ``--shard``) as JSON lines,
+    to be combined into a JIRA importer document by ``--merge``.
+
+    The first line says which shard the file holds, and each following line
+    holds a converted project without its JIRA key, along with its position in
+    GitLab's project listing and the GitLab name the key will be made from.
+    The last line lists the users mentioned by the shard's projects, so a
+    missing last line means the shard did not finish.
+    '''
+
+    def __init__(self, output, shard):
+        '''
+        :param output: File-like object to write the shard to.
+        :param shard: ``(shard index, number of shards)`` tuple.
+        '''
+        self.output = output
+        self._write_line({'shard': list(shard)})
+
+    def _write_line(self, obj):
+        self.output.write(json.dumps(obj, separators=(',', ':')) + '\n')
+
+    def write_project(self, position, gitlab_name, jira_project):
+        ''' Write a finished project to the shard and flush it. '''
+        self._write_line({'position': position, 'gitlab_name': gitlab_name,
+                          'project': jira_project})
+        self.output.flush()
+
+    def close(self, mentioned_users, run_started):
+        ''' Finish the shard. '''
+        user_ids = dict(sorted(mentioned_users.items()))
+        self._write_line({'mentioned_users': user_ids,
+                          'run_started': run_started.isoformat()})
+        self.output.flush()
+
+
+def load_user_ids(saved_users):
+    '''
+    :returns: Dictionary mapping usernames to user ids, from one saved by a
+              shard or checkpoint. Older ones only saved a list of usernames,
+              whose ids are not known.
+    '''
+    if isinstance(saved_users, list):
+        return dict.fromkeys(saved_users)
+    return dict(saved_users)
+
+
+def read_shard_header(path):
+    '''
+    :returns: The ``(shard index, number of shards)`` tuple for a shard file.
+    '''
+    with open(path) as shard_file:
+        return tuple(json.loads(shard_file.readline())['shard'])
+
+
+def read_shard(shard_file, mentioned_users, run_starts):
+    '''
+    Generate the ``(position, gitlab_name, jira_project)`` tuples saved in a
+    shard file written by :class:`ShardWriter`, in order.
+
+    :param mentioned_users: Dictionary the shard's mentioned users (and their
+                            ids) are added to once all of its projects have
+                            been read.
+    :param run_starts: List the time the shard started is appended to.
+    :raises ValueError: If the shard is incomplete.
+    '''
+    shard_file.readline()
+    for line in shard_file:
+        entry = json.loads(line)
+        if 'project' in entry:
+            yield entry['position'], entry['gitlab_name'], entry['project']
+        else:
+            mentioned_users.update(load_user_ids(entry['mentioned_users']))
+            run_starts.append(parsedate(entry['run_started']))
+            return
+    raise ValueError('Shard {} is incomplete. Was its export '
+                     'interrupted?'.format(shard_file.name))
+
+
+def merge_shards(paths, writer, mentioned_users, metrics, progress):
+    '''
+    Write the projects from every shard to ``writer`` in the order GitLab
+    listed them, assigning JIRA keys exactly like an unsharded export would.
+
+    :param mentioned_users: Dictionary the users mentioned by any shard are
+                            added to, mapped to their user ids.
+    :param metrics: :class:`metrics.Metrics` to time writing the output with.
+    :param progress: :class:`metrics.ProgressLine` to update after each
+                     project.
+    :returns: When the earliest shard started.
+    '''
+    key_set = set()
+    run_starts = []
+    with ExitStack() as stack:
+        shards = [read_shard(stack.enter_context(open(path)), mentioned_users,
+                             run_starts)
+                  for path in paths]
+        for _, gitlab_name, jira_project in heapq.merge(*shards,
+                                                        key=itemgetter(0)):
+            jira_project['key'] = make_project_key(gitlab_name, key_set)
+            with metrics.timer('write', profile=True):
+                writer.write_project(jira_project)
+            progress.update()
+    return min(run_starts)
+
+
+def run_shard_processes(git, argv, args, shard_dir):
+    '''
+    Export every shard in its own process, by running :func:`main` with the
+    same arguments plus ``--shard``.
+
+    :returns: List of the shard files written to ``shard_dir``.
+    '''
+    if args.catalog:
+        # Crawl GitLab here, if needed, rather than in every shard
+        for _ in list_projects(git, args.page_size, catalog_path=args.catalog,
+                               ttl=args.catalog_ttl):
+            pass
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # Pass on the credentials, in case they were entered interactively
+    if not args.token:
+        argv += ['--username', args.username, '--password', args.password]
+    attachment_budget = None
+    if args.attachment_dir and args.attachment_max_size is not None:
+        # Count the files kept from previous runs once here, because every
+        # shard would otherwise count them against its own share
+        attachment_budget = max(
+            0, int(args.attachment_max_size * 1024 ** 3) -
+            AttachmentStore.stored_bytes(args.attachment_dir))
+    shard_paths = []
+    shard_argvs = []
+    for index in range(args.processes):
+        shard = '{}/{}'.format(index, args.processes)
+        shard_path = os.path.join(shard_dir, 'shard{}.jsonl'.format(index))
+        shard_argv = argv + ['--processes', '1', '--shard', shard,
+                             '--output', shard_path]
+        if args.checkpoint_dir:
+            shard_argv += ['--checkpoint_dir',
+                           os.path.join(args.checkpoint_dir,
+                                        'shard{}'.format(index))]
+        # The shards share the attachment directory, so they split what is
+        # left of its limit
+        if attachment_budget is not None:
+            shard_argv += ['--attachment_budget',
+                           str(attachment_budget // args.processes)]
+        # Each shard saves its own issues, metrics and profile next to the
+        # merge's. A store that is only read from is shared, since each shard
+        # only reads its own projects from it.
+        for option in ('issue_store', 'metrics_file', 'profile'):
+            path = getattr(args, option)
+            if option == 'issue_store' and args.from_store:
+                continue
+            if path:
+                root, ext = os.path.splitext(path)
+                shard_argv += ['--' + option,
+                               '{}.shard{}{}'.format(root, index, ext)]
+        shard_paths.append(shard_path)
+        shard_argvs.append(shard_argv)
+    with ProcessPoolExecutor(args.processes) as process_pool:
+        list(process_pool.map(main, shard_argvs))
+    return shard_paths
+
+
+class ExportCheckpoint(object):
+    '''
+    Saves every finished project (after conversion) to a checkpoint directory,
+    so that an interrupted export can be resumed without retrieving those
+    projects from GitLab again.
+
+    The JIRA key and the users each project contributed are saved along with
+    it, so replaying the saved projects in order restores the ``key_set`` and
+    ``mentioned_users`` state exactly as it was.
+    '''
+
+    def __init__(self, path, run_started, resume=False):
+        '''
+        :param path: Checkpoint directory. Created if it does not exist.
+        :param run_started: When this run started.
+        :param resume: Keep the projects saved by a previous run instead of
+                       starting from scratch. In that case ``run_started`` is
+                       replaced with the start time of the interrupted run.
+        '''
+        self.projects_dir = os.path.join(path, 'projects')
+        self.state_path = os.path.join(path, 'state.json')
+        os.makedirs(self.projects_dir, exist_ok=True)
+        if resume and os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            self.run_started = parsedate(state['run_started'])
+            self.finished_ids = {int(file_name[:-len('.json')]) for file_name
+                                 in os.listdir(self.projects_dir)
+                                 if file_name.endswith('.json')}
+        else:
+            for file_name in os.listdir(self.projects_dir):
+                os.remove(os.path.join(self.projects_dir, file_name))
+            self.run_started = run_started
+            self.finished_ids = set()
+            write_json_atomic(self.state_path,
+                              {'run_started': run_started.isoformat()})
+
+    def _project_path(self, project_id):
+        return os.path.join(self.projects_dir, '{}.json'.format(project_id))
+
+    def save_project(self, project_id, jira_project, project_users):
+        '''
+        Record that a project is finished.
+
+        :param jira_project: The converted project, or None if it was not
+                             included in the output.
+        :param project_users: Dictionary mapping the usernames mentioned in
+                              the project to their user ids.
+        '''
+        write_json_atomic(self._project_path(project_id),
+                          {'project': jira_project,
+                           'mentioned_users': dict(sorted(
+                               project_users.items()))})
+        self.finished_ids.add(project_id)
+
+    def load_project(self, project_id):
+        '''
+        :returns: The ``(jira_project, project_users)`` saved for a project.
+        '''
+        with open(self._project_path(project_id)) as project_file:
+            saved = json.load(project_file)
+        return saved['project'], load_user_ids(saved['mentioned_users'])
+
+
+class IssueStore(object):
+    '''
+    SQLite database of the raw GitLab projects, issues and notes retrieved by
+    an export, so that the JIRA output can be rendered again (e.g., after
+    changing how issues are converted) without retrieving them again.
+
+    Each issue is stored along with its notes as compressed JSON, indexed by
+    project and issue id. Projects are kept in the order GitLab listed them,
+    so rendering from the store assigns the same keys.
+    '''
+
+    def __init__(self, path, clear=False):
+        '''
+        :param path: SQLite database file. Created if it does not exist.
+        :param clear: Delete everything saved by a previous export.
+        '''
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS projects ('
+                                    'position INTEGER PRIMARY KEY, '
+                                    'id INTEGER NOT NULL, '
+                                    'project BLOB NOT NULL, '
+                                    'exported INTEGER NOT NULL, '
+                                    'attachments BLOB)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS issues ('
+                                    'project_id INTEGER NOT NULL, '
+                                    'position INTEGER NOT NULL, '
+                                    'issue_id INTEGER NOT NULL, '
+                                    'issue BLOB NOT NULL, '
+                                    'notes BLOB NOT NULL, '
+                                    'PRIMARY KEY (project_id, position))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS issue_ids ON '
+                                    'issues (project_id, issue_id)')
+            if clear:
+                self.connection.execute('DELETE FROM projects')
+                self.connection.execute('DELETE FROM issues')
+
+    @staticmethod
+    def _pack(obj):
+        return zlib.compress(json.dumps(obj,
+                                        separators=(',', ':')).encode('utf-8'))
+
+    @staticmethod
+    def _unpack(blob):
+        return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM projects').fetchone()[0]
+
+    def save_project(self, position, project, project_issues,
+                     attachments=None):
+        '''
+        Save a project along with its issues and their notes, replacing
+        anything saved for it before.
+
+        :param position: Position of the project in GitLab's listing.
+        :param project_issues: List of ``(issue, notes)`` tuples, or None if
+                               the project is not exported.
+        :param attachments: Downloaded attachments for the project, as
+                            returned by :func:`download_uploads`.
+        '''
+        with self.connection:
+            self.connection.execute('DELETE FROM projects WHERE position = ?',
+                                    (position,))
+            self.connection.execute('DELETE FROM issues WHERE project_id = ?',
+                                    (project['id'],))
+            self.connection.execute(
+                'INSERT INTO projects VALUES (?, ?, ?, ?, ?)',
+                (position, project['id'], self._pack(project),
+                 project_issues is not None,
+                 None if attachments is None else self._pack(attachments)))
+            self.connection.executemany(
+                'INSERT INTO issues VALUES (?, ?, ?, ?, ?)',
+                ((project['id'], issue_num, issue['id'], self._pack(issue),
+                  self._pack(notes))
+                 for issue_num, (issue, notes)
+                 in enumerate(project_issues or ())))
+
+    def issues(self, project_id):
+        ''' Generate the ``(issue, notes)`` tuples saved for a project. '''
+        for issue, notes in self.connection.execute(
+                'SELECT issue, notes FROM issues WHERE project_id = ? '
+                'ORDER BY position', (project_id,)):
+            yield self._unpack(issue), self._unpack(notes)
+
+    def projects(self, shard=(0, 1)):
+        '''
+        Generate the ``(position, project, project_issues, attachments)``
+        tuples saved for the projects in ``shard``, in order. Issues are only
+        read from the database as ``project_issues`` is iterated over.
+        '''
+        shard_index, num_shards = shard
+        for position, project_id, project, exported, attachments in list(
+                self.connection.execute(
+                    'SELECT position, id, project, exported, attachments '
+                    'FROM projects WHERE id % ? = ? ORDER BY position',
+                    (num_shards, shard_index))):
+            project_issues = None
+            if exported:
+                project_issues = StoredIssues(self, project_id)
+            if attachments is not None:
+                attachments = self._unpack(attachments)
+            yield (position, self._unpack(project), project_issues,
+                   attachments)
+
+    def close(self):
+        ''' Close the database. '''
+        self.connection.close()
+
+
+class StoredIssues(object):
+    '''
+    The issues of a project saved in an :class:`IssueStore`, which are read
+    from it each time they are iterated over instead of held in memory.
+    '''
+
+    def __init__(self, store, project_id):
+        self.store = store
+        self.project_id = project_id
+        self._len = store.connection.execute(
+            'SELECT COUNT(*) FROM issues WHERE project_id = ?',
+            (project_id,)).fetchone()[0]
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.store.issues(self.project_id)
+
+
+class UserCache(object):
+    '''
+    Local cache of GitLab user records, keyed by username, so that users who
+    were already looked up by a recent run don't have to be retrieved again.
+    '''
+
+    def __init__(self, path=None, ttl=24 * 60 * 60):
+        '''
+        :param path: JSON file to load the cache from and save it to. If None,
+                     the cache only lasts for this run.
+        :param ttl: Number of seconds a cached user record stays valid for.
+        '''
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as cache_file:
+                self.entries = json.load(cache_file)
+
+    def get(self, username):
+        '''
+        :returns: The cached record for ``username``, or None if it isn't
+                  cached or has expired.
+        '''
+        entry = self.entries.get(username)
+        if entry is None or time.time() - entry['fetched_at'] > self.ttl:
+            return None
+        return entry['user']
+
+    def add(self, user):
+        ''' Cache a user record retrieved from GitLab. '''
+        self.entries[user['username']] = {'user': user,
+                                          'fetched_at': time.time()}
+
+    def save(self):
+        ''' Save the cache, if it has a file. '''
+        if self.path is not None:
+            write_json_atomic(self.path, self.entries)
+
+
+class AttachmentStore(object):
+    '''
+    Directory that files uploaded to GitLab issues and notes are downloaded
+    to, so they can be imported into JIRA as attachments.
+
+    Files are streamed to disk and named after the SHA-256 hash of their
+    contents, so a file that was uploaded several times is only stored once.
+    Downloads that would make the files in the directory take up more than
+    ``max_bytes`` are abandoned.
+    '''
+
+    def __init__(self, path, max_bytes=None, base_url=None,
+                 count_existing=True):
+        '''
+        :param path: Directory to save the files in. Created if it does not
+                     exist.
+        :param max_bytes: Most bytes all the files may take up, or None for
+                          no limit.
+        :param base_url: URL the directory will be served at for JIRA to
+                         import the attachments from. If None, ``file:`` URIs
+                         are used.
+        :param count_existing: Count the files kept from previous runs
+                               towards ``max_bytes``. If False, ``max_bytes``
+                               only limits the files this store adds, e.g.,
+                               when it is one of several shards that split
+                               what is left of the limit.
+        '''
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.base_url = base_url
+        self.used_bytes = self.stored_bytes(path) if count_existing else 0
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.skipped = 0
+        self._files = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stored_bytes(path):
+        ''' :returns: How many bytes the files in directory ``path`` take. '''
+        if not os.path.isdir(path):
+            return 0
+        return sum(entry.stat().st_size for entry in os.scandir(path)
+                   if entry.is_file() and not entry.name.startswith('.'))
+
+    def _skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    def _reserve(self, num_bytes):
+        with self._lock:
+            if (self.max_bytes is not None and
+                    self.used_bytes + num_bytes > self.max_bytes):
+                return False
+            self.used_bytes += num_bytes
+            return True
+
+    def _release(self, num_bytes):
+        with self._lock:
+            self.used_bytes -= num_bytes
+
+    def uri(self, file_name):
+        ''' :returns: The URI JIRA should import a stored file from. '''
+        if self.base_url:
+            return self.base_url.rstrip('/') + '/' + quote(file_name)
+        return Path(os.path.abspath(os.path.join(self.path,
+                                                 file_name))).as_uri()
+
+    def fetch(self, git, url):
+        '''
+        Download a file, unless it was already downloaded during this run.
+
+        :returns: Name of the file in the directory, or None if it could not
+                  be downloaded or would not fit.
+        '''
+        with self._lock:
+            if url in self._files:
+                return self._files[url]
+        temp_file = tempfile.NamedTemporaryFile(dir=self.path,
+                                                prefix='.download',
+                                                delete=False)
+        digest = hashlib.sha256()
+        size = 0
+        file_name = None
+        try:
+            with temp_file:
+                chunks = git.download(url)
+                if chunks is None:
+                    logging.warning('Could not download attachment %s.', url)
+                    self._skip()
+                    return None
+                for chunk in chunks:
+                    if not self._reserve(len(chunk)):
+                        chunks.close()
+                        logging.warning('Skipping attachment %s, because the '
+                                        'attachment directory is full.', url)
+                        self._release(size)
+                        self._skip()
+                        return None
+                    size += len(chunk)
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+            file_name = digest.hexdigest() + os.path.splitext(url)[1]
+            with self._lock:
+                if os.path.exists(os.path.join(self.path, file_name)):
+                    self.used_bytes -= size
+                    self.deduplicated += 1
+                else:
+                    os.replace(temp_file.name,
+                               os.path.join(self.path, file_name))
+                    self.downloaded += 1
+                self._files[url] = file_name
+        except (GitLabAPIError, IOError) as error:
+            logging.warning('Could not download attachment %s: %s', url,
+                            error)
+            self._release(size)
+            self._skip()
+        finally:
+            if os.path.exists(temp_file.name):
+                os.remove(temp_file.name)
+        return file_name
+
+
+def download_uploads(git, project, project_issues, store, pool):
+    '''
+    Download every file uploaded to GitLab that the issues and notes of a
+    project link to, using ``pool`` to download several at once.
+
+    :param store: :class:`AttachmentStore` to download the files to.
+    :returns: Dictionary mapping the upload paths that were downloaded to the
+              URIs JIRA should import them from.
+    '''
+    paths = set()
+    for issue, notes in project_issues:
+        paths.update(UPLOAD_RE.findall(issue['description'] or ''))
+        for note in notes:
+            paths.update(UPLOAD_RE.findall(note['body'] or ''))
+    paths = sorted(paths)
+    file_names = pool.map(lambda path: store.fetch(git,
+                                                   project['web_url'] + path),
+                          paths)
+    return {path: store.uri(file_name)
+            for path, file_name in zip(paths, file_names)
+            if file_name is not None}
+
+
+def find_user(git, username, user_id=None):
+    '''
+    Look up a single user, with a single request if possible.
+
+    Users are looked up by id when it is known, since that is exact. Otherwise,
+    GitLab versions that support it filter on the exact ``username``. Older
+    ones ignore that and fall back to ``search``, which also matches other
+    users whose name or email contains ``username``, so only the first page of
+    those (of the largest size GitLab allows) is checked.
+
+    :returns: The user record, or None if there is no such user.
+    '''
+    if user_id is not None:
+        user = git.getuser(user_id)
+        if user and user['username'] == username:
+            return user
+    users = git.getusers(search=username, username=username,
+                         per_page=MAX_PER_PAGE)
+    for user in users or []:
+        if user['username'] == username:
+            return user
+    return None
+
+
+def resolve_users(git, user_ids, user_cache, page_size, workers):
+    '''
+    Retrieve the GitLab records for a set of users, using ``user_cache``
+    where possible.
+
+    Users that aren't cached are looked up individually, ``workers`` at a
+    time, unless there are so many of them that paging through every user on
+    GitLab would take fewer requests.
+
+    :param user_ids: Dictionary mapping usernames to GitLab user ids, or to
+                     None where the id is not known.
+    :returns: List of the user records found, sorted by id.
+    '''
+    missing = sorted(username for username in user_ids
+                     if user_cache.get(username) is None)
+    if missing:
+        # Find out how many users there are with a single tiny request
+        probe = git.getusers(per_page=1)
+        total_users = getattr(probe, 'total', None)
+        if (total_users is not None and
+                len(missing) >= math.ceil(total_users / page_size)):
+            logging.info('Retrieving all %d GitLab users to find %d missing '
+                         'from the cache.', total_users, len(missing))
+            for user in gen_all_results(git.getusers, per_page=page_size):
+                user_cache.add(user)
+        else:
+            logging.info('Looking up %d GitLab users missing from the cache.',
+                         len(missing))
+            with ThreadPoolExecutor(workers) as user_pool:
+                for user in user_pool.map(
+                        lambda username: find_user(git, username,
+                                                   user_ids[username]),
+                        missing):
+                    if user is not None:
+                        user_cache.add(user)
+        user_cache.save()
+    users = []
+    for username in user_ids:
+        user = user_cache.get(username)
+        if user is None:
+            logging.warning('Could not find GitLab user %s, so they are left '
+                            'out of the users.', username)
+        else:
+            users.append(user)
+    return sorted(users, key=lambda user: user['id'])
+
+
+def attachment_name(path):
+    '''
+    :returns: The name a file uploaded to GitLab is attached to JIRA as.
+    '''
+    return unquote(os.path.basename(path))
+
+
+def convert_attachments(md_string, attacher, created, attachments):
     '''
-    Little helper function to generate all pages of results for a given method
-    in one list.
+    :returns: JIRA importer attachments for the uploads linked to in a
+              Markdown string that were downloaded.
+    '''
+    jira_attachments = []
+    for path in UPLOAD_RE.findall(md_string or ''):
+        if path in attachments:
+            jira_attachments.append({'name': attachment_name(path),
+                                     'attacher': attacher,
+                                     'created': created,
+                                     'uri': attachments[path]})
+    return jira_attachments
+
+
+def convert_project(project, key, project_issues, mentioned_users,
+                    attachments=None):
+    '''
+    Convert a GitLab project and its issues to a JIRA importer project.
+
+    :param project_issues: List of ``(issue, notes)`` tuples for the project.
+    :param mentioned_users: Dictionary that the usernames of every reporter,
+                            assignee and comment author are added to, mapped
+                            to their GitLab user ids.
+    :param attachments: Dictionary mapping upload paths to the URIs of the
+                        downloaded files, as returned by
+                        :func:`download_uploads`. If None, issues have no
+                        attachments.
+    '''
+    jira_project = {}
+    jira_project['name'] = project['name_with_namespace']
+    jira_project['key'] = key
+    jira_project['description'] = md_to_wiki(project['description'])
+    # jira_project['created'] = project['created_at']
+    jira_project['issues'] = []
+    # Links to downloaded files point at the issue's attachments instead
+    attached = frozenset(attachments or ())
+    for issue, notes in project_issues:
+        jira_issue = {}
+        jira_issue['externalId'] = issue['iid']
+        if issue['state'] == 'closed':
+            jira_issue['status'] = 'Closed'
+            jira_issue['resolution'] = 'Resolved'
+        else:
+            jira_issue['status'] = 'Open'
+
+        jira_issue['description'] = md_to_wiki(issue['description'],
+                                               attached)
+        jira_issue['reporter'] = issue['author']['username']
+        mentioned_users[jira_issue['reporter']] = issue['author'].get('id')
+        jira_issue['labels'] = issue['labels']
+        jira_issue['summary'] = issue['title']
+        if issue['assignee']:
+            jira_issue['assignee'] = issue['assignee']['username']
+            mentioned_users[jira_issue['assignee']] = issue['assignee'].get(
+                'id')
+        jira_issue['issueType'] = 'Bug'
+        jira_issue['comments'] = []
+        for note in notes:
+            jira_note = {}
+            jira_note['body'] = md_to_wiki(note['body'], attached)
+            jira_note['author'] = note['author']['username']
+            mentioned_users[jira_note['author']] = note['author'].get('id')
+            jira_note['created'] = note['created_at']
+            jira_issue['comments'].append(jira_note)
+        if attachments is not None:
+            jira_attachments = convert_attachments(
+                issue['description'], jira_issue['reporter'],
+                issue['created_at'], attachments)
+            for note in notes:
+                jira_attachments.extend(convert_attachments(
+                    note['body'], note['author']['username'],
+                    note['created_at'], attachments))
+            # Each file only needs to be attached to the issue once
+            uris = set()
+            for attachment in jira_attachments:
+                if attachment['uri'] not in uris:
+                    uris.add(attachment['uri'])
+                    jira_issue.setdefault('attachments', []).append(
+                        attachment)
+        jira_project['issues'].append(jira_issue)
+    return jira_project
+
+
+def get_project_issues(git, project, args, ignore_list, note_pool,
+                       skip_ids=frozenset()):
+    '''
+    Retrieve all of the issues for a project that pass the date filter, along
+    with the notes for each of them.
+
+    The notes for every issue are retrieved exactly once, and are used both to
+    decide whether an old issue has recent activity and to build its comments.
+
+    :returns: A tuple of a list of ``(issue, notes)`` tuples in the order
+              GitLab returned the issues (or None if the project should not
+              be exported), and the number of note requests saved by not
+              fetching the notes of old issues a second time. Projects in
+              ``skip_ids`` are not retrieved at all.
     '''
-    get_more = True
-    page_num = 0
-    if 'page' in kwargs:
-        kwargs.pop('page')
-    while get_more:
-        page_num += 1
-        proj_page = method(*args, page=page_num, per_page=per_page, **kwargs)
-        # proj_page will be False if method fails
-        if proj_page:
-            get_more = len(proj_page) == per_page
-            yield from iter(proj_page)
+    proj_name_lower = project['name'].lower()
+    if (project['id'] in skip_ids or proj_name_lower in ignore_list or
+            not project['issues_enabled']):
+        return None, 0
+    # Let GitLab drop old issues when it supports updated_after (GitLab adds
+    # notes by updating the issue). Older versions ignore the parameter, so
+    # the filter below is still applied on our side as a fallback.
+    filter_kwargs = {}
+    if args.date_filter > EPOCH:
+        filter_kwargs['updated_after'] = args.date_filter.strftime(
+            '%Y-%m-%dT%H:%M:%SZ')
+    issues = list(gen_all_results(git.getprojectissues, project['id'],
+                                  per_page=args.page_size, **filter_kwargs))
+    issue_notes = note_pool.map(partial(git.getissuewallnotes, project['id']),
+                                [issue['id'] for issue in issues])
+    project_issues = []
+    saved_requests = 0
+    for issue, notes in zip(issues, issue_notes):
+        issue_updated = parsedate(issue['updated_at']).replace(tzinfo=None)
+        if args.date_filter < issue_updated:
+            project_issues.append((issue, notes))
         else:
-            get_more = False
+            for note in notes:
+                note_created = parsedate(note['created_at']).replace(
+                    tzinfo=None)
+                if args.date_filter < note_created:
+                    project_issues.append((issue, notes))
+                    saved_requests += 1
+                    break
+    return project_issues, saved_requests
 
 
-def md_to_wiki(md_string):
+def _convert_markdown_match(match, attached=frozenset()):
+    '''
+    Replacement function for :data:`MARKDOWN_RE` that converts whichever
+    construct it matched.
+
+    :param attached: Upload paths of the files attached to the issue, which
+                     links are turned into attachment links for.
+    '''
+    if match.group('code') is not None:
+        # Contents of code blocks are left alone, apart from the closing fence
+        code = match.group('code')
+        if code.endswith('```'):
+            code = code[:-3] + '{code}'
+        if match.group('lang'):
+            return '{code:' + match.group('lang') + '}' + code
+        return '{code}' + code
+    elif match.group('link_text') is not None:
+        image = match.group('image') or ''
+        if match.group('url') in attached:
+            name = attachment_name(match.group('url'))
+            if image:
+                return '!' + name + '!'
+            return '[^' + name + ']'
+        link = '[' + match.group('link_text') + '|' + match.group('url') + ']'
+        # Usernames inside the link text or URL are converted too
+        return image + USERNAME_RE.sub(r'[~\1]\2', link)
+    else:
+        return '[~' + match.group('username') + ']' + match.group('end')
+
+
+@lru_cache(maxsize=4096)
+def md_to_wiki(md_string, attached=frozenset()):
     '''
     Take Markdown-formatted comments and convert them to Wiki format.
+
+    The whole document is converted in a single pass over
+    :data:`MARKDOWN_RE`. Results are cached, since templated issues and bot
+    comments often have identical bodies.
+
+    :param attached: Upload paths of the files attached to the issue. Links
+                     to them are turned into JIRA attachment links (``!name!``
+                     for images, ``[^name]`` for other files).
+    '''
+    if md_string is None:
+        return '\n'
+    lines = md_string.splitlines()
+    if not lines:
+        return ''
+    md_string = '\n'.join(lines)
+    # Emoji
+    md_string = md_string.replace(':+1:', '(y)').replace(':-1:', '(n)')
+    # Code blocks, hyperlinks, and usernames
+    return MARKDOWN_RE.sub(partial(_convert_markdown_match,
+                                   attached=attached), md_string) + '\n'
+
+
+def export_projects(git, args, writer, mentioned_users, run_started,
+                    metrics):
+    '''
+    Retrieve, convert and write every project (or only those in
+    ``args.shard``). With ``args.from_store``, the projects and issues saved
+    in ``args.issue_store`` are converted instead.
+
+    :param writer: :class:`JiraJSONWriter`, or :class:`ShardWriter` if
+                   ``args.shard`` is set, in which case projects are written
+                   without a JIRA key.
+    :param mentioned_users: Dictionary the users mentioned in any project are
+                            added to, mapped to their user ids.
+    :param run_started: When this run started.
+    :param metrics: :class:`metrics.Metrics` to record how long each stage
+                    and project took in.
+    :returns: When this export started, which is earlier than
+              ``run_started`` if an interrupted export was resumed.
     '''
-    output_buf = StringIO()
-    if md_string is not None:
-        for line in md_string.splitlines():
-            # Code blocks
-            line = re.sub(r'```([a-z]+)$', r'{code:\1}', line)
-            line = re.sub(r'```$', r'{code}', line)
-            # Emoji
-            line = line.replace(':+1:', '(y)')
-            line = line.replace(':-1:', '(n)')
-            # Hyperlinks
-            line = re.sub(r'\[([^\]]+)\]\(([^\)]+)\)', r'[\1|\2]', line)
-            # Usernames
-            line = re.sub(r'@([a-zA-Z0-9]+)(\b|_$)', r'[~\1]\2', line)
-            print(line, file=output_buf)
+    shard_index, num_shards = args.shard or (0, 1)
+    key_set = set()
+    saved_note_requests = 0
+    if args.ignore_list is not None:
+        ignore_list = {line.strip().lower() for line in args.ignore_list}
+    else:
+        ignore_list = {}
+    if args.checkpoint_dir:
+        checkpoint = ExportCheckpoint(args.checkpoint_dir, run_started,
+                                      resume=args.resume)
+        run_started = checkpoint.run_started
+        finished_ids = frozenset(checkpoint.finished_ids)
+        if finished_ids:
+            logging.info('Resuming export with %d finished projects.',
+                         len(finished_ids))
+    else:
+        checkpoint = None
+        finished_ids = frozenset()
+    if args.attachment_dir:
+        max_bytes = args.attachment_max_size
+        if max_bytes is not None:
+            max_bytes = int(max_bytes * 1024 ** 3)
+        if args.attachment_budget is not None:
+            max_bytes = args.attachment_budget
+        attachment_store = AttachmentStore(
+            args.attachment_dir, max_bytes=max_bytes,
+            base_url=args.attachment_url,
+            count_existing=args.attachment_budget is None)
+    else:
+        attachment_store = None
+    if args.issue_store:
+        issue_store = IssueStore(args.issue_store,
+                                 clear=not (args.resume or args.from_store))
     else:
-        print('', file=output_buf)
-    return output_buf.getvalue()
+        issue_store = None
+    if args.from_store:
+        num_projects = issue_store.connection.execute(
+            'SELECT MAX(position) + 1 FROM projects').fetchone()[0]
+    else:
+        num_projects = count_projects(git, catalog_path=args.catalog,
+                                      ttl=args.catalog_ttl)
+    progress = ProgressLine('Creating project entries', total=num_projects)
+    # Projects are numbered by their position in the full listing, so that
+    # shards can be merged back into the same order
+    projects = ((position, project) for position, project in
+                enumerate(list_projects(git, args.page_size,
+                                        catalog_path=args.catalog,
+                                        ttl=args.catalog_ttl))
+                if project['id'] % num_shards == shard_index)
+    # Issues and notes are retrieved by the worker pools, but everything that
+    # affects the output (key assignment, conversion) happens here in the
+    # order GitLab lists the projects, so the output is deterministic.
+    with ThreadPoolExecutor(args.workers) as project_pool, \
+            ThreadPoolExecutor(args.workers) as note_pool, \
+            ThreadPoolExecutor(args.workers) as attachment_pool:
+        get_issues = partial(get_project_issues, git, args=args,
+                             ignore_list=ignore_list, note_pool=note_pool,
+                             skip_ids=finished_ids)
+
+        def fetch_issues(item):
+            project = item[1]
+            timings = {}
+            with metrics.timer('fetch_issues', item=timings):
+                project_issues, saved = get_issues(project)
+            attachments = None
+            if attachment_store is not None and project_issues:
+                with metrics.timer('attachments', item=timings):
+                    attachments = download_uploads(git, project,
+                                                   project_issues,
+                                                   attachment_store,
+                                                   attachment_pool)
+            return project_issues, saved, attachments, timings
+
+        if args.from_store:
+            # Render the issues saved by an earlier export instead, applying
+            # the ignore list again in case it changed
+            fetched = (((position, project),
+                        (None if project['name'].lower() in ignore_list
+                         else project_issues, 0, attachments, {}))
+                       for position, project, project_issues, attachments
+                       in issue_store.projects(args.shard or (0, 1)))
+        else:
+            fetched = imap_ordered(project_pool, fetch_issues, projects,
+                                   args.workers * 2)
+        for (position, project), (project_issues, saved, attachments,
+                                  timings) in fetched:
+            saved_note_requests += saved
+            if project['id'] in finished_ids:
+                with metrics.timer('checkpoint'):
+                    jira_project, project_users = checkpoint.load_project(
+                        project['id'])
+                if jira_project is not None:
+                    key_set.add(jira_project['key'])
+            else:
+                if issue_store is not None and not args.from_store:
+                    with metrics.timer('issue_store'):
+                        issue_store.save_project(position, project,
+                                                 project_issues, attachments)
+                jira_project = None
+                project_users = {}
+                if project_issues is not None and (project_issues or
+                                                   args.include_empty):
+                    # Shards leave the keys to be assigned when merging
+                    if args.shard:
+                        key = None
+                    else:
+                        key = make_project_key(project['name'], key_set)
+                    with metrics.timer('convert', profile=True,
+                                       item=timings):
+                        jira_project = convert_project(project, key,
+                                                       project_issues,
+                                                       project_users,
+                                                       attachments)
+                    metrics.count('convert', issues=len(project_issues))
+                if checkpoint is not None:
+                    with metrics.timer('checkpoint'):
+                        checkpoint.save_project(project['id'], jira_project,
+                                                project_users)
+            mentioned_users.update(project_users)
+            if jira_project is not None:
+                with metrics.timer('write', profile=True):
+                    if args.shard:
+                        writer.write_project(position, project['name'],
+                                             jira_project)
+                    else:
+                        writer.write_project(jira_project)
+            metrics.record(name=project['name_with_namespace'],
+                           issues=len(project_issues or ()), **timings)
+            progress.update(position + 1)
+    progress.close()
+
+    logging.info('Saved %d GitLab requests by retrieving each issue\'s notes '
+                 'only once.', saved_note_requests)
+    if attachment_store is not None:
+        logging.info('Downloaded %d attachments (%d more were duplicates, '
+                     'and %d were skipped).', attachment_store.downloaded,
+                     attachment_store.deduplicated, attachment_store.skipped)
+        metrics.count('attachments', downloaded=attachment_store.downloaded,
+                      deduplicated=attachment_store.deduplicated,
+                      skipped=attachment_store.skipped)
+    if issue_store is not None:
+        issue_store.close()
+    return run_started
+
+
+def finish_metrics(metrics, git, metrics_file):
+    '''
+    Add the GitLab request and ``md_to_wiki`` cache counters to ``metrics``,
+    and save them to ``metrics_file`` (if set) and the profile (if enabled).
+    '''
+    metrics.add_request_stats('gitlab', git.stats)
+    cache_info = md_to_wiki.cache_info()
+    metrics.count('md_to_wiki', hits=cache_info.hits,
+                  misses=cache_info.misses)
+    metrics.close(metrics_file)
 
 
 def main(argv=None):
@@ -88,6 +1175,39 @@ def main(argv=None):
         conflict_handler='resolve')
     parser.add_argument('gitlab_url',
                         help='The full URL to your GitLab instance.')
+    parser.add_argument('-a', '--attachment_dir',
+                        help='Download the files uploaded to GitLab that \
+                              issues and comments link to into this \
+                              directory, and add them to the issues as \
+                              attachments. Identical files are only stored \
+                              once.')
+    parser.add_argument('--attachment_max_size',
+                        help='Stop downloading attachments once the files in \
+                              --attachment_dir take up this many gigabytes.',
+                        type=float)
+    # Set by --processes for each shard: how many bytes of attachments the
+    # shard may add to --attachment_dir, regardless of what is already there
+    parser.add_argument('--attachment_budget', help=argparse.SUPPRESS,
+                        type=int)
+    parser.add_argument('--attachment_url',
+                        help='URL that --attachment_dir will be served at \
+                              for JIRA to import the attachments from. By \
+                              default, attachments are imported from file: \
+                              URIs, which only works if JIRA runs on this \
+                              machine.')
+    parser.add_argument('--catalog',
+                        help='SQLite file to save the list of GitLab \
+                              projects in, so that later runs of this script \
+                              or gitlab_to_stash.py within --catalog_ttl do \
+                              not have to retrieve it from GitLab again.')
+    parser.add_argument('--catalog_ttl',
+                        help='How many seconds a saved --catalog can be \
+                              reused for.',
+                        type=float, default=3600)
+    parser.add_argument('-C', '--checkpoint_dir',
+                        help='Directory to save each finished project to, so \
+                              that an interrupted export can be continued \
+                              with --resume.')
     parser.add_argument('-d', '--date_filter',
                         help='Only include issues, notes, etc. created after\
                               the specified date. Expected format is \
@@ -97,9 +1217,46 @@ def main(argv=None):
                         help='Include projects in output that do not have any\
                               issues.',
                         action='store_true')
+    parser.add_argument('--from_store',
+                        help='Convert the projects, issues and notes saved in \
+                              --issue_store by an earlier export instead of \
+                              retrieving them from GitLab. Users are still \
+                              looked up, unless they are in --user_cache.',
+                        action='store_true')
     parser.add_argument('-i', '--ignore_list',
                         help='List of project names to exclude from dump.',
                         type=argparse.FileType('r'))
+    parser.add_argument('-I', '--issue_store',
+                        help='SQLite file to save the GitLab projects, issues \
+                              and notes to as they are retrieved, so that \
+                              they can be converted again later with \
+                              --from_store. With --processes, each shard \
+                              saves to a file of its own, but a single file \
+                              can be converted with any number of \
+                              processes.')
+    parser.add_argument('-o', '--output',
+                        help='File to write the JSON to. Each project is \
+                              written as soon as it has been retrieved.',
+                        type=argparse.FileType('w'), default='-')
+    parser.add_argument('-c', '--compact',
+                        help='Write compact JSON instead of indenting it.',
+                        action='store_true')
+    parser.add_argument('--merge',
+                        help='Instead of retrieving projects from GitLab, \
+                              combine the files written by exporting every \
+                              shard with --shard into a single JIRA JSON \
+                              document. GitLab is still used to look up the \
+                              users.',
+                        nargs='+', metavar='SHARD_FILE')
+    parser.add_argument('-M', '--max_connections',
+                        help='Maximum number of simultaneous connections to \
+                              GitLab. Connections are kept open and reused.',
+                        type=int, default=10)
+    parser.add_argument('--metrics_file',
+                        help='File to save the time spent in each stage, the \
+                              GitLab request counts and the time taken by \
+                              each project to. Written as CSV if the name \
+                              ends with .csv, and as JSON otherwise.')
     parser.add_argument('-p', '--password',
                         help='The password to use to authenticate if token is \
                               not specified. If password and token are both \
@@ -107,8 +1264,48 @@ def main(argv=None):
                               password.')
     parser.add_argument('-P', '--page_size',
                         help='When retrieving result from GitLab, how many \
-                              results should be included in a given page?.',
-                        type=int, default=20)
+                              results should be included in a given page? \
+                              GitLab returns at most {} \
+                              per page.'.format(MAX_PER_PAGE),
+                        type=int, default=MAX_PER_PAGE)
+    parser.add_argument('-w', '--workers',
+                        help='Number of projects (and issues within a project)\
+                              to retrieve from GitLab in parallel. Output is \
+                              identical regardless of this setting.',
+                        type=int, default=1)
+    parser.add_argument('-j', '--processes',
+                        help='Split the projects between this many processes \
+                              (as with --shard) and merge their output. \
+                              Output is identical regardless of this \
+                              setting.',
+                        type=int, default=1)
+    parser.add_argument('--profile',
+                        help='File to save cProfile statistics for the \
+                              CPU-bound stages (converting and writing \
+                              projects) to, for use with pstats.')
+    parser.add_argument('-r', '--resume',
+                        help='Continue an interrupted export, skipping the \
+                              projects already saved in --checkpoint_dir. \
+                              The output is the same as for an uninterrupted \
+                              run.',
+                        action='store_true')
+    parser.add_argument('--shard',
+                        help='Only export the projects whose ID modulo N is \
+                              i, given as i/N, to a partial output file for \
+                              --merge. Shards can be exported on different \
+                              machines at the same time.',
+                        type=get_shard)
+    parser.add_argument('--since_last_run',
+                        help='Path to a file where the time of the last \
+                              successful run is stored. If it exists, only \
+                              issues updated since then are included (or \
+                              since --date_filter, whichever is later). It is \
+                              updated at the end of every successful run.')
+    parser.add_argument('-R', '--max_retries',
+                        help='How many times to retry a GitLab request that \
+                              failed with a transient error (such as a 429 \
+                              or 502) before giving up.',
+                        type=int, default=5)
     parser.add_argument('-s', '--verify_ssl',
                         help='Enable SSL certificate verification',
                         action='store_true')
@@ -119,6 +1316,14 @@ def main(argv=None):
     parser.add_argument('-u', '--username',
                         help='The username to use for authentication, if token\
                               is unspecified.')
+    parser.add_argument('-U', '--user_cache',
+                        help='File to cache GitLab user records in, so that \
+                              later runs only have to look up users that are \
+                              not in it yet.')
+    parser.add_argument('--user_cache_ttl',
+                        help='How many seconds a user record in --user_cache \
+                              can be reused for.',
+                        type=float, default=24 * 60 * 60)
     parser.add_argument('-v', '--verbose',
                         help='Print more status information. For every ' +
                              'additional time this flag is specified, ' +
@@ -128,7 +1333,30 @@ def main(argv=None):
                         version='%(prog)s {0}'.format(__version__))
     args = parser.parse_args(argv)
 
-    args.page_size = max(100, args.page_size)
+    args.page_size = min(max(1, args.page_size), MAX_PER_PAGE)
+    args.workers = max(1, args.workers)
+    if args.resume and not args.checkpoint_dir:
+        parser.error('--resume requires --checkpoint_dir')
+    if args.from_store:
+        if not args.issue_store:
+            parser.error('--from_store requires --issue_store')
+        if not os.path.isfile(args.issue_store):
+            parser.error('--issue_store {} does not exist'.format(
+                args.issue_store))
+        issue_store = IssueStore(args.issue_store)
+        num_stored = len(issue_store)
+        issue_store.close()
+        if not num_stored:
+            parser.error('--issue_store {} has no projects saved in it'.format(
+                args.issue_store))
+    if sum([args.processes > 1, args.shard is not None,
+            args.merge is not None]) > 1:
+        parser.error('--processes, --shard and --merge cannot be combined')
+    if args.merge:
+        shards = sorted(read_shard_header(path) for path in args.merge)
+        if shards != [(index, len(shards)) for index in range(len(shards))]:
+            parser.error('--merge needs exactly one file for every shard')
+    run_started = datetime.utcnow()
 
     # Convert verbose flag to actually logging level
     log_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
@@ -138,6 +1366,14 @@ def main(argv=None):
     logging.basicConfig(format=('%(asctime)s - %(name)s - %(levelname)s - ' +
                                 '%(message)s'), level=log_level)
 
+    if args.since_last_run:
+        last_run = read_high_water_mark(args.since_last_run)
+        if last_run is not None:
+            last_run = last_run.replace(tzinfo=None)
+            logging.info('Only including issues updated since last run at %s',
+                         last_run)
+            args.date_filter = max(args.date_filter, last_run)
+
     # Setup authenticated GitLab instance
     if args.token:
         git = GitLab(args.gitlab_url, token=args.token,
@@ -150,109 +1386,70 @@ def main(argv=None):
             args.password = getpass.getpass('Password: ')
         git = GitLab(args.gitlab_url, verify_ssl=args.verify_ssl)
         git.login(args.username, args.password)
+    git = GitLabClient(git, max_connections=args.max_connections,
+                       max_retries=args.max_retries)
 
-    # Initialize output dictionary
-    output_dict = defaultdict(list)
+    metrics = Metrics(profile_path=args.profile)
+    if args.processes > 1:
+        shard_dir = tempfile.mkdtemp(prefix='dump_gitlab_json.')
+        args.merge = run_shard_processes(git, argv, args, shard_dir)
+    else:
+        shard_dir = None
 
-    print('Creating project entries...', end="", file=sys.stderr)
-    sys.stderr.flush()
-    key_set = set()
-    mentioned_users = set()
-    if args.ignore_list is not None:
-        ignore_list = {line.strip().lower() for line in args.ignore_list}
+    # Initialize output document
+    if args.shard:
+        writer = ShardWriter(args.output, args.shard)
     else:
-        ignore_list = {}
-    for project in gen_all_results(git.getprojectsall,
-                                   per_page=args.page_size):
-        proj_name_lower = project['name'].lower()
-        if proj_name_lower not in ignore_list and project['issues_enabled']:
-            project_issues = []
-            for issue in gen_all_results(git.getprojectissues, project['id'],
-                                         per_page=args.page_size):
-                if args.date_filter < parsedate(issue['updated_at']).replace(tzinfo=None):
-                    project_issues.append(issue)
-                else:
-                    for note in git.getissuewallnotes(project['id'],
-                                                      issue['id']):
-                        if args.date_filter < parsedate(issue['updated_at']).replace(tzinfo=None):
-                            project_issues.append(issue)
-                            break
-
-            if project_issues or args.include_empty:
-                jira_project = {}
-                jira_project['name'] = project['name_with_namespace']
-                key = project['name']
-                if key.islower():
-                    key = key.title()
-                key = re.sub(r'[^A-Z]', '', key)
-                if len(key) < 2:
-                    key = re.sub(r'[^A-Za-z]', '',
-                                 project['name'])[0:2].upper()
-                added = False
-                suffix = 65
-                while key in key_set:
-                    if not added:
-                        key += 'A'
-                    else:
-                        suffix += 1
-                        key = key[:-1] + chr(suffix)
-                key_set.add(key)
-                jira_project['key'] = key
-                jira_project['description'] = md_to_wiki(project['description'])
-                # jira_project['created'] = project['created_at']
-                jira_project['issues'] = []
-                for issue in project_issues:
-                    jira_issue = {}
-                    jira_issue['externalId'] = issue['iid']
-                    if issue['state'] == 'closed':
-                        jira_issue['status'] = 'Closed'
-                        jira_issue['resolution'] = 'Resolved'
-                    else:
-                        jira_issue['status'] = 'Open'
-
-                    jira_issue['description'] = md_to_wiki(issue['description'])
-                    jira_issue['reporter'] = issue['author']['username']
-                    mentioned_users.add(jira_issue['reporter'])
-                    jira_issue['labels'] = issue['labels']
-                    jira_issue['summary'] = issue['title']
-                    if issue['assignee']:
-                        jira_issue['assignee'] = issue['assignee']['username']
-                        mentioned_users.add(jira_issue['assignee'])
-                    jira_issue['issueType'] = 'Bug'
-                    jira_issue['comments'] = []
-                    # Get all comments/notes
-                    for note in git.getissuewallnotes(project['id'],
-                                                      issue['id']):
-                        jira_note = {}
-                        jira_note['body'] = md_to_wiki(note['body'])
-                        jira_note['author'] = note['author']['username']
-                        mentioned_users.add(jira_note['author'])
-                        jira_note['created'] = note['created_at']
-                        jira_issue['comments'].append(jira_note)
-                    jira_project['issues'].append(jira_issue)
-
-                output_dict['projects'].append(jira_project)
-        print('.', end="", file=sys.stderr)
-        sys.stderr.flush()
-
-    print('\nCreating user entries...', end="", file=sys.stderr)
-    sys.stderr.flush()
-    for user in gen_all_results(git.getusers, per_page=args.page_size):
-        # Only add users who are actually referenced in issues
-        if user['username'] in mentioned_users:
-            jira_user = {}
-            jira_user['name'] = user['username']
-            jira_user['fullname'] = user['name']
-            jira_user['email'] = user['email']
-            jira_user['groups'] = ['gitlab-users']
-            jira_user['active'] = (user['state'] == 'active')
-            output_dict['users'].append(jira_user)
-        print('.', end="", file=sys.stderr)
-        sys.stderr.flush()
-
-    print('\nPrinting JSON output...', file=sys.stderr)
+        writer = JiraJSONWriter(args.output,
+                                indent=None if args.compact else 4)
+
+    mentioned_users = {}
+    if args.merge:
+        progress = ProgressLine('Merging project entries')
+        run_started = merge_shards(args.merge, writer, mentioned_users,
+                                   metrics, progress)
+        progress.close()
+        if shard_dir is not None:
+            shutil.rmtree(shard_dir)
+    else:
+        run_started = export_projects(git, args, writer, mentioned_users,
+                                      run_started, metrics)
+
+    if args.shard:
+        # Users are looked up once all the shards are merged
+        print('Finishing shard output...', file=sys.stderr)
+        writer.close(mentioned_users, run_started)
+        git.print_stats()
+        finish_metrics(metrics, git, args.metrics_file)
+        return
+
+    # Only add users who are actually referenced in issues
+    user_cache = UserCache(args.user_cache, ttl=args.user_cache_ttl)
+    with metrics.timer('resolve_users'):
+        users = resolve_users(git, mentioned_users, user_cache,
+                              args.page_size, args.workers)
+    progress = ProgressLine('Creating user entries', total=len(users))
+    for user in users:
+        jira_user = {}
+        jira_user['name'] = user['username']
+        jira_user['fullname'] = user['name']
+        jira_user['email'] = user['email']
+        jira_user['groups'] = ['gitlab-users']
+        jira_user['active'] = (user['state'] == 'active')
+        with metrics.timer('write', profile=True):
+            writer.write_user(jira_user)
+        progress.update()
+    progress.close()
+
+    print('Finishing JSON output...', file=sys.stderr)
     sys.stderr.flush()
-    print(json.dumps(output_dict, indent=4))
+    writer.close()
+    git.print_stats()
+    finish_metrics(metrics, git, args.metrics_file)
+
+    # Rendering saved issues doesn't retrieve anything new from GitLab
+    if args.since_last_run and not args.from_store:
+        write_high_water_mark(args.since_last_run, run_started)
 
 
 if __name__ == '__main__':
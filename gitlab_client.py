@@ -0,0 +1,419 @@
+# License: BSD 3 clause
+'''
+Pooled HTTP client for the GitLab API endpoints used by the migration scripts,
+and helpers for paging through their results.
+'''
+
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Status codes that mean a request should be tried again later
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Status codes that mean our credentials are invalid or lack access, which
+# must not be mistaken for there being no results
+AUTH_STATUSES = {401, 403}
+# Headers pyapi-gitlab authenticates requests with
+AUTH_HEADERS = {'private-token', 'authorization'}
+# The most results GitLab will return in a single page
+MAX_PER_PAGE = 100
+# How many pages gen_all_results requests at once when it knows how many
+# there are
+PAGE_WORKERS = 4
+
+
+class Page(list):
+    '''
+    One page of results from a GitLab listing, along with the pagination
+    information GitLab sent with it (None if it didn't).
+    '''
+
+    def __init__(self, results, total=None, total_pages=None):
+        super(Page, self).__init__(results)
+        self.total = total
+        self.total_pages = total_pages
+
+
+class GitLabAPIError(Exception):
+    '''
+    Raised when a request to GitLab keeps failing with a transient error
+    after all retries, or is refused because of our credentials, so it isn't
+    mistaken for the end of the results.
+    '''
+    pass
+
+
+def mount_pooled_adapter(session, max_connections):
+    '''
+    Make ``session`` keep up to ``max_connections`` keep-alive connections
+    open per host, and make any further concurrent requests wait for one of
+    them to be free instead of opening a new connection.
+    '''
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections,
+                          pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+def parse_retry_after(value):
+    '''
+    :returns: The number of seconds a ``Retry-After`` header says to wait,
+              which may be given as either seconds or an HTTP date.
+    '''
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() -
+                       time.time())
+        except (TypeError, ValueError):
+            return 0.0
+
+
+class RateLimiter(object):
+    '''
+    Limits the requests made to a server by all threads together.
+
+    When the server says to back off (a ``Retry-After`` header, or GitLab's
+    ``RateLimit-Remaining`` reaching zero), every thread waits. The number of
+    requests allowed in flight at once is also adapted: it is halved whenever
+    we are throttled, and grows back by one after a run of successful
+    requests.
+    '''
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._resume_at = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        ''' Wait until another request may be sent. '''
+        with self._condition:
+            while True:
+                wait = self._resume_at - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self._in_flight < self.concurrency:
+                    self._in_flight += 1
+                    return
+                else:
+                    self._condition.wait()
+
+    def release(self, throttled=False):
+        ''' Record that a request finished, and whether it was throttled. '''
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self.concurrency = max(1, self.concurrency // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if (self._successes >= self.concurrency and
+                        self.concurrency < self.max_concurrency):
+                    self.concurrency += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        ''' Stop all requests for ``seconds``. '''
+        with self._condition:
+            self._resume_at = max(self._resume_at,
+                                  time.monotonic() + seconds)
+            self._condition.notify_all()
+
+    def update(self, response):
+        '''
+        Pause when GitLab's rate limit headers say we have used up our
+        requests until the limit resets.
+        '''
+        remaining = response.headers.get('RateLimit-Remaining')
+        reset = response.headers.get('RateLimit-Reset')
+        if remaining is not None and reset is not None:
+            try:
+                if int(remaining) <= 0:
+                    self.pause(float(reset) - time.time())
+            except ValueError:
+                pass
+
+
+class GitLabClient(object):
+    '''
+    Drop-in replacement for the pyapi-gitlab methods used by the migration
+    scripts.
+
+    pyapi-gitlab opens a new connection (with a new TLS handshake) for every
+    request. This client sends all requests through one ``requests.Session``,
+    so connections are reused, and it is safe to share between threads.
+
+    Requests that fail with a transient error (429, 5xx, or a connection
+    problem) are retried with jittered exponential backoff, and the shared
+    :class:`RateLimiter` slows everyone down when GitLab asks us to.
+    '''
+
+    def __init__(self, git, max_connections=10, max_retries=5,
+                 backoff=1.0, timeout=60):
+        '''
+        :param git: Authenticated ``gitlab.Gitlab`` instance to take the URL,
+                    credentials and SSL settings from.
+        :param max_connections: Maximum number of simultaneous connections to
+                                GitLab.
+        :param max_retries: How many times to retry a request that failed
+                            with a transient error before giving up.
+        :param backoff: Base number of seconds to wait before retrying.
+        :param timeout: Seconds to wait for GitLab to respond to a request.
+        '''
+        self.api_url = git.api_url
+        self.session = requests.Session()
+        # Only take the credentials: pyapi-gitlab's login() also sets
+        # "connection: close", which would defeat the connection pool
+        self.session.headers.update((name, value) for name, value
+                                    in git.headers.items()
+                                    if name.lower() in AUTH_HEADERS)
+        self.session.verify = git.verify_ssl
+        mount_pooled_adapter(self.session, max_connections)
+        self.rate_limiter = RateLimiter(max_connections)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # Number of requests, retries, throttled requests, failures, bytes
+        # received and seconds spent for each endpoint
+        self.stats = defaultdict(Counter)
+        self._stats_lock = threading.Lock()
+
+    def _count(self, endpoint, stat, amount=1):
+        with self._stats_lock:
+            self.stats[endpoint][stat] += amount
+
+    def _request(self, endpoint, url, stream=False, **params):
+        '''
+        :param endpoint: Name to record statistics for this request under.
+        :param stream: Don't download the response body until it is read.
+        :returns: The response, or None if GitLab rejected the request (e.g.,
+                  it does not exist).
+        :raises GitLabAPIError: If the request still failed with a transient
+                                error after retrying, or GitLab refused our
+                                credentials (401 or 403).
+        '''
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._count(endpoint, 'retries')
+            self.rate_limiter.acquire()
+            self._count(endpoint, 'requests')
+            start = time.perf_counter()
+            response = None
+            throttled = False
+            try:
+                response = self.session.get(url, params=params, stream=stream,
+                                            timeout=self.timeout)
+                throttled = response.status_code == 429
+            except requests.RequestException as error:
+                failure = str(error)
+                delay = 0.0
+            finally:
+                self.rate_limiter.release(throttled=throttled)
+            if response is not None:
+                self._count(endpoint, 'seconds', time.perf_counter() - start)
+                self.rate_limiter.update(response)
+                if response.status_code == 200:
+                    return response
+                response.close()
+                if response.status_code in AUTH_STATUSES:
+                    self._count(endpoint, 'failures')
+                    raise GitLabAPIError('GitLab refused the request for {}: '
+                                         '{} {}. Check that the token is '
+                                         'still valid and has access.'.format(
+                                             url, response.status_code,
+                                             response.reason))
+                if response.status_code not in RETRY_STATUSES:
+                    return None
+                if throttled:
+                    self._count(endpoint, 'throttled')
+                failure = '{} {}'.format(response.status_code,
+                                         response.reason)
+                delay = parse_retry_after(response.headers.get('Retry-After',
+                                                               '0'))
+                if delay:
+                    self.rate_limiter.pause(delay)
+            # Full jitter, but never sooner than the server asked for
+            delay = max(delay, random.uniform(0, self.backoff * 2 ** attempt))
+            if attempt < self.max_retries:
+                time.sleep(delay)
+        self._count(endpoint, 'failures')
+        raise GitLabAPIError('GitLab request for {} failed after {} retries: '
+                             '{}'.format(url, self.max_retries, failure))
+
+    def _get(self, endpoint, path, **params):
+        '''
+        :returns: The decoded JSON response, or False if GitLab rejected the
+                  request (e.g., it does not exist), like pyapi-gitlab does.
+        :raises GitLabAPIError: If the request still failed with a transient
+                                error after retrying, or GitLab refused our
+                                credentials.
+        '''
+        response = self._request(endpoint, self.api_url + path, **params)
+        if response is None:
+            return False
+        self._count(endpoint, 'bytes', len(response.content))
+        return self._decode(response)
+
+    def download(self, url, chunk_size=64 * 1024):
+        '''
+        Download a file from GitLab (such as an upload attached to an issue)
+        in chunks, without holding all of it in memory.
+
+        :param url: Full URL of the file.
+        :returns: Generator of chunks of the file, or None if GitLab rejected
+                  the request.
+        :raises GitLabAPIError: If the request still failed with a transient
+                                error after retrying.
+        '''
+        response = self._request('download', url, stream=True)
+        if response is None:
+            return None
+        return self._iter_chunks(response, chunk_size)
+
+    def _iter_chunks(self, response, chunk_size):
+        with response:
+            for chunk in response.iter_content(chunk_size):
+                self._count('download', 'bytes', len(chunk))
+                yield chunk
+
+    @staticmethod
+    def _decode(response):
+        '''
+        Decode a response, keeping GitLab's ``X-Total`` and ``X-Total-Pages``
+        headers for listings.
+        '''
+        results = response.json()
+        if not isinstance(results, list):
+            return results
+        counts = []
+        for header in ('X-Total', 'X-Total-Pages'):
+            try:
+                counts.append(int(response.headers[header]))
+            except (KeyError, ValueError):
+                counts.append(None)
+        return Page(results, *counts)
+
+    def print_stats(self, file=sys.stderr):
+        ''' Print the request, retry and throttling counts per endpoint. '''
+        print('GitLab requests by endpoint (requests/retries/throttled):',
+              file=file)
+        with self._stats_lock:
+            for endpoint, stats in sorted(self.stats.items()):
+                print('\t{}: {}/{}/{}'.format(endpoint, stats['requests'],
+                                              stats['retries'],
+                                              stats['throttled']),
+                      file=file)
+
+    def getprojectsall(self, page=1, per_page=20, **kwargs):
+        return self._get('getprojectsall', '/projects/all', page=page,
+                         per_page=per_page, **kwargs)
+
+    def getproject(self, project_id, **kwargs):
+        return self._get('getproject', '/projects/{}'.format(project_id),
+                         **kwargs)
+
+    def getprojectissues(self, project_id, page=1, per_page=20, **kwargs):
+        return self._get('getprojectissues',
+                         '/projects/{}/issues'.format(project_id), page=page,
+                         per_page=per_page, **kwargs)
+
+    def getissuewallnotes(self, project_id, issue_id, page=1, per_page=20):
+        return self._get('getissuewallnotes',
+                         '/projects/{}/issues/{}/notes'.format(project_id,
+                                                               issue_id),
+                         page=page, per_page=per_page)
+
+    def getusers(self, search=None, page=1, per_page=20, username=None):
+        params = {'page': page, 'per_page': per_page}
+        if search:
+            params['search'] = search
+        if username:
+            params['username'] = username
+        return self._get('getusers', '/users', **params)
+
+    def getuser(self, user_id):
+        return self._get('getuser', '/users/{}'.format(user_id))
+
+
+def imap_ordered(executor, func, iterable, window):
+    '''
+    Like ``executor.map``, but only keeps ``window`` calls in flight at once,
+    so a long (or lazy) iterable is not consumed all up front. Yields
+    ``(item, result)`` pairs in the same order as ``iterable``, regardless of
+    the order in which the calls finish.
+    '''
+    pending = deque()
+    for item in iterable:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def gen_all_results(method, *args, per_page=20, **kwargs):
+    '''
+    Little helper function to generate all pages of results for a given method
+    in one list.
+
+    If the first page says how many pages there are in total (GitLab's
+    ``X-Total-Pages`` header), the rest are requested :data:`PAGE_WORKERS` at
+    a time. Otherwise they are requested one after another, with the next page
+    requested in the background while the current one is processed.
+    '''
+    if 'page' in kwargs:
+        kwargs.pop('page')
+
+    def get_page(page_num):
+        return method(*args, page=page_num, per_page=per_page, **kwargs)
+
+    def check_page(page_num, proj_page):
+        # A listing that GitLab rejects part way through (e.g., because a
+        # token expired) must not look like it simply ended there
+        if proj_page is False and page_num > 1:
+            raise GitLabAPIError('GitLab rejected page {} of {}'.format(
+                page_num, getattr(method, '__name__', method)))
+        return proj_page
+
+    with ThreadPoolExecutor(PAGE_WORKERS) as page_pool:
+        page_num = 1
+        next_page = page_pool.submit(get_page, page_num)
+        while next_page is not None:
+            proj_page = check_page(page_num, next_page.result())
+            # proj_page will be False if GitLab rejects the first request
+            # (e.g., the project does not exist). Transient failures are
+            # retried and raise GitLabAPIError instead, so they can't be
+            # mistaken for the end of the results.
+            if not proj_page:
+                return
+            total_pages = getattr(proj_page, 'total_pages', None)
+            if page_num == 1 and total_pages is not None:
+                yield from iter(proj_page)
+                for page_num, proj_page in imap_ordered(
+                        page_pool, get_page, range(2, total_pages + 1),
+                        PAGE_WORKERS * 2):
+                    if not check_page(page_num, proj_page):
+                        return
+                    yield from iter(proj_page)
+                return
+            if len(proj_page) == per_page:
+                page_num += 1
+                next_page = page_pool.submit(get_page, page_num)
+            else:
+                next_page = None
+            yield from iter(proj_page)
@@ -10,38 +10,492 @@ Clone all projects from GitLab and recreate them on Stash
 
 import argparse
 import getpass
+import json
 import logging
 import os
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import stashy
 from gitlab import Gitlab as GitLab
 
+from gitlab_client import (MAX_PER_PAGE, GitLabAPIError, GitLabClient,
+                           mount_pooled_adapter)
+from metrics import Metrics, ProgressLine
+from project_catalog import (count_projects, list_projects,
+                             make_project_key)
+
 
 __version__ = '0.1.0'
 
 
-def gen_all_results(method, *args, per_page=20, **kwargs):
+def clone_mirror(project, repo_dir):
+    '''
+    Make ``repo_dir`` an up-to-date bare mirror of a GitLab repository.
+
+    If ``repo_dir`` already holds a mirror from a previous run, only the refs
+    that changed since then are fetched. Otherwise (or if updating the old
+    mirror fails) the repository is cloned from scratch.
+
+    :returns: True if the mirror is ready, False if the repository could not
+              be cloned.
+    '''
+    if os.path.isdir(repo_dir):
+        print('\nUpdating cached mirror of GitLab repository "%s"...' %
+              project['name_with_namespace'], file=sys.stderr)
+        sys.stderr.flush()
+        try:
+            subprocess.check_call(['git', 'remote', 'set-url', 'origin',
+                                   project['ssh_url_to_repo']], cwd=repo_dir)
+            subprocess.check_call(['git', 'remote', 'update', '--prune'],
+                                  cwd=repo_dir)
+            return True
+        except subprocess.CalledProcessError:
+            print('Failed to update cached mirror, so cloning it again.',
+                  file=sys.stderr)
+            shutil.rmtree(repo_dir)
+
+    print('\nCloning GitLab repository "%s"...' %
+          project['name_with_namespace'], file=sys.stderr)
+    sys.stderr.flush()
+    try:
+        subprocess.check_call(['git', 'clone', '--mirror',
+                               project['ssh_url_to_repo'], repo_dir])
+    except subprocess.CalledProcessError:
+        print('Failed to clone GitLab repository "%s". This usually when ' %
+              project['name_with_namespace'] + 'it does not exist.',
+              file=sys.stderr)
+        # Don't leave a partial clone behind in the cache
+        shutil.rmtree(repo_dir, ignore_errors=True)
+        return False
+    return True
+
+
+def push_mirror(project, repo_dir, stash_repo_url, batched_push=None):
     '''
-    Little helper function to generate all pages of results for a given method
-    in one list.
+    Push a bare mirror to Stash, unless it is empty.
+
+    All git commands are run with ``cwd`` set to the mirror rather than
+    changing the working directory of the whole process, so several
+    repositories can be mirrored at the same time.
+
+    :param batched_push: :class:`BatchedPush` to push the mirror with, for
+                         large repositories. If None, everything is pushed
+                         at once.
+    :returns: ``'transferred'`` if the repository was pushed to Stash,
+              ``'empty'`` if it has no commits, or ``'push_failed'`` if the
+              push (or ``batched_push``) failed.
     '''
-    get_more = True
-    page_num = 0
-    if 'page' in kwargs:
-        kwargs.pop('page')
-    while get_more:
-        page_num += 1
-        proj_page = method(*args, page=page_num, per_page=per_page, **kwargs)
-        # proj_page will be False if method fails
-        if proj_page:
-            get_more = len(proj_page) == per_page
-            yield from iter(proj_page)
+    repo_desc = project['name_with_namespace']
+    # Check that repository is not empty
+    try:
+        subprocess.check_call(['git', 'log', '--format=oneline', '-1'],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, cwd=repo_dir)
+    except subprocess.CalledProcessError:
+        print('Repository "%s" is empty, so skipping push to Stash.' %
+              repo_desc, file=sys.stderr)
+        return 'empty'
+
+    # Push straight to the Stash URL, so that origin keeps pointing at GitLab
+    # for the next update of a cached mirror. Only refs that differ are sent.
+    print('\nPushing repository "%s" to Stash...' % repo_desc,
+          file=sys.stderr)
+    sys.stderr.flush()
+    try:
+        if batched_push is not None:
+            batched_push.push(repo_dir, stash_repo_url)
         else:
-            get_more = False
+            subprocess.check_call(['git', 'push', '--mirror', stash_repo_url],
+                                  cwd=repo_dir)
+    except (subprocess.CalledProcessError,
+            subprocess.TimeoutExpired) as error:
+        print('Failed to push repository "%s" to Stash: %s' %
+              (repo_desc, error), file=sys.stderr)
+        return 'push_failed'
+    return 'transferred'
+
+
+class StashIndex(object):
+    '''
+    Index of all Stash projects and their repositories (with slugs and clone
+    links), built with a single crawl of Stash and optionally saved to a local
+    file, so repeated runs don't have to crawl Stash again.
+    '''
+
+    def __init__(self, projects, crawled_at):
+        '''
+        :param projects: Dictionary mapping project keys to dictionaries with
+                         the project ``name`` and its ``repos``, which map
+                         repository names to their ``slug`` and ``links``.
+        :param crawled_at: Time (in seconds since the epoch) Stash was crawled.
+        '''
+        self.projects = projects
+        self.crawled_at = crawled_at
+        self.names_to_keys = {proj['name']: key for key, proj in
+                              projects.items()}
+        self.path = None
+
+    @classmethod
+    def crawl(cls, stash, jobs=1):
+        '''
+        Build an index by listing every Stash project once, and then the
+        repositories of ``jobs`` projects at a time.
+        '''
+        crawled_at = time.time()
+        stash_projects = list(stash.projects)
+        with ThreadPoolExecutor(jobs) as pool:
+            repo_lists = pool.map(
+                lambda proj: list(stash.projects[proj['key']].repos),
+                stash_projects)
+            projects = {}
+            for proj, repos in zip(stash_projects, repo_lists):
+                projects[proj['key']] = {
+                    'name': proj['name'],
+                    'repos': {repo['name']: {'slug': repo['slug'],
+                                             'links': repo['links']}
+                              for repo in repos}}
+        return cls(projects, crawled_at)
+
+    @classmethod
+    def load(cls, path, ttl):
+        '''
+        Load an index saved by :meth:`save`.
+
+        :param ttl: Maximum age of the index in seconds.
+        :returns: The index, or None if there is no saved index or it is too
+                  old.
+        '''
+        if not os.path.exists(path):
+            return None
+        with open(path) as index_file:
+            saved = json.load(index_file)
+        if time.time() - saved['crawled_at'] > ttl:
+            return None
+        index = cls(saved['projects'], saved['crawled_at'])
+        index.path = path
+        return index
+
+    def save(self, path):
+        ''' Save the index so a later run can :meth:`load` it. '''
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as index_file:
+            json.dump({'crawled_at': self.crawled_at,
+                       'projects': self.projects}, index_file)
+        os.replace(temp_path, path)
+        self.path = path
+
+    def _invalidate(self):
+        # Remove the saved copy as soon as we change Stash, so that it isn't
+        # reused out of date if we die before saving it again.
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.path = None
+
+    def add_project(self, key, name):
+        ''' Record that a project was created on Stash. '''
+        self._invalidate()
+        self.projects[key] = {'name': name, 'repos': {}}
+        self.names_to_keys[name] = key
+
+    def add_repo(self, key, stash_repo):
+        ''' Record that a repository was created in project ``key``. '''
+        self._invalidate()
+        self.projects[key]['repos'][stash_repo['name']] = {
+            'slug': stash_repo['slug'], 'links': stash_repo['links']}
+
+
+def get_ref_tips(repo_url):
+    '''
+    List the refs of a remote repository without fetching anything.
+
+    :returns: Dictionary mapping ref names to the SHA-1s they point at, or
+              None if the repository could not be listed.
+    '''
+    try:
+        output = subprocess.check_output(['git', 'ls-remote', repo_url],
+                                         stderr=subprocess.DEVNULL,
+                                         universal_newlines=True)
+    except subprocess.CalledProcessError:
+        return None
+    ref_tips = {}
+    for line in output.splitlines():
+        sha, ref = line.split('\t', 1)
+        # HEAD is symbolic and is not pushed by --mirror
+        if ref != 'HEAD':
+            ref_tips[ref] = sha
+    return ref_tips
+
+
+def repos_match(gitlab_repo_url, stash_repo_url):
+    '''
+    Cheaply check whether a Stash repository already has exactly the same refs
+    as the GitLab one, in which case there is nothing to transfer.
+    '''
+    gitlab_tips = get_ref_tips(gitlab_repo_url)
+    return (gitlab_tips is not None and
+            gitlab_tips == get_ref_tips(stash_repo_url))
+
+
+class RepositorySizes(object):
+    '''
+    Looks up the size of each project's repository in GitLab's project
+    statistics.
+
+    Newer versions of GitLab include the statistics in the project listing.
+    Otherwise each project is requested separately, until GitLab returns one
+    without statistics, which means it does not provide them at all.
+    '''
+
+    def __init__(self, git):
+        self.git = git
+        self.lookups_supported = True
+
+    def get(self, project):
+        '''
+        :returns: The size of a project's repository in bytes, or None if it
+                  is not known.
+        '''
+        statistics = project.get('statistics')
+        if statistics is None and self.lookups_supported:
+            try:
+                details = self.git.getproject(project['id'], statistics=True)
+            except GitLabAPIError as error:
+                logging.warning('Could not look up the size of repository '
+                                '"%s": %s', project['name_with_namespace'],
+                                error)
+                details = None
+            else:
+                statistics = details.get('statistics') if details else None
+                if details and statistics is None:
+                    logging.info('GitLab does not provide project statistics, '
+                                 'so all repositories are pushed at once.')
+                    self.lookups_supported = False
+        if not statistics:
+            return None
+        return statistics.get('repository_size')
+
+
+class BatchedPush(object):
+    '''
+    Pushes a large mirror to Stash in many small pushes instead of a single
+    ``git push --mirror``, which can take longer than a proxy in front of
+    Stash allows.
+
+    First the history of the default branch is pushed ``history_step``
+    commits at a time, then the remaining refs are pushed ``batch_size`` at a
+    time, and finally ``git push --mirror`` removes any refs that were
+    deleted on GitLab. Each push is killed if it takes longer than
+    ``timeout`` seconds and tried again up to ``retries`` times.
+
+    Only refs that differ between the mirror and Stash are pushed, so a
+    transfer that failed partway resumes after the last batch that made it.
+    '''
+    # Limit the memory git uses for delta compression while packing
+    GIT_CONFIG = ['-c', 'pack.windowMemory=256m',
+                  '-c', 'pack.deltaCacheSize=64m']
+
+    def __init__(self, batch_size=1000, history_step=10000, timeout=None,
+                 retries=3):
+        '''
+        :param batch_size: Number of refs to push at once.
+        :param history_step: Number of commits on the default branch to push
+                             at once.
+        :param timeout: Seconds after which a single push is given up on, or
+                        None to wait indefinitely.
+        :param retries: How many times to try a failed push again.
+        '''
+        self.batch_size = batch_size
+        self.history_step = history_step
+        self.timeout = timeout
+        self.retries = retries
+
+    def _run(self, args, repo_dir):
+        ''' Run a git command in the mirror, retrying it if it fails. '''
+        command = ['git'] + self.GIT_CONFIG + args
+        for attempt in range(self.retries + 1):
+            try:
+                subprocess.check_call(command, cwd=repo_dir,
+                                      timeout=self.timeout)
+                return
+            except (subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired) as error:
+                if attempt == self.retries:
+                    raise
+                print('%s, so trying again.' % error, file=sys.stderr)
+                time.sleep(2 ** attempt)
+
+    def _push_history(self, repo_dir, stash_repo_url, ref, stash_sha):
+        '''
+        Push the first-parent history of ``ref`` in steps, starting after the
+        commit Stash already has (if it is on that history).
+        '''
+        commits = subprocess.check_output(['git', 'rev-list',
+                                           '--first-parent', '--reverse', ref],
+                                          cwd=repo_dir,
+                                          universal_newlines=True).split()
+        start = 0
+        if stash_sha in commits:
+            start = commits.index(stash_sha) + 1
+        # The tip itself is pushed with the rest of the refs
+        steps = commits[start + self.history_step - 1:-1:self.history_step]
+        for step_num, sha in enumerate(steps, 1):
+            print('Pushing history of %s (step %d of %d)...' %
+                  (ref, step_num, len(steps)), file=sys.stderr)
+            self._run(['push', '--force', stash_repo_url,
+                       '{}:{}'.format(sha, ref)], repo_dir)
+
+    def push(self, repo_dir, stash_repo_url):
+        '''
+        Push the mirror in ``repo_dir`` to Stash.
+
+        :raises subprocess.CalledProcessError: If a push still failed after
+                                               retrying.
+        :raises subprocess.TimeoutExpired: If a push still timed out after
+                                           retrying.
+        '''
+        stash_tips = get_ref_tips(stash_repo_url) or {}
+        # Peeled tags (ending with ^{}) are listed but are not refs
+        local_tips = get_ref_tips(repo_dir) or {}
+        refs = sorted(ref for ref, sha in local_tips.items()
+                      if not ref.endswith('^{}') and
+                      stash_tips.get(ref) != sha)
+        try:
+            default_branch = subprocess.check_output(
+                ['git', 'symbolic-ref', 'HEAD'], cwd=repo_dir,
+                stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+        except subprocess.CalledProcessError:
+            default_branch = None
+        if default_branch in refs:
+            self._push_history(repo_dir, stash_repo_url, default_branch,
+                               stash_tips.get(default_branch))
+        num_batches = -(-len(refs) // self.batch_size)
+        for batch_num, start in enumerate(range(0, len(refs),
+                                                self.batch_size), 1):
+            print('Pushing refs (batch %d of %d)...' % (batch_num,
+                                                        num_batches),
+                  file=sys.stderr)
+            self._run(['push', '--force', stash_repo_url] +
+                      ['{0}:{0}'.format(ref)
+                       for ref in refs[start:start + self.batch_size]],
+                      repo_dir)
+        self._run(['push', '--mirror', stash_repo_url], repo_dir)
+
+
+def transfer_mirror(project, repo_dir, stash_repo_url, metrics, repo,
+                    batched_push=None):
+    '''
+    Clone (or update) the mirror of a GitLab repository in ``repo_dir`` and
+    push it to Stash.
+
+    :param metrics: :class:`metrics.Metrics` to time the clone and push with.
+    :param repo: Dictionary of measurements for the repository, which the
+                 clone and push times and the size of the mirror are added to.
+    :param batched_push: Passed on to :func:`push_mirror`.
+    :returns: The result of :func:`push_mirror`, or ``'clone_failed'``.
+    '''
+    with metrics.timer('clone', item=repo):
+        cloned = clone_mirror(project, repo_dir)
+    if not cloned:
+        return 'clone_failed'
+    repo['size_bytes'] = dir_size(repo_dir)
+    metrics.count('clone', bytes=repo['size_bytes'])
+    with metrics.timer('push', item=repo):
+        return push_mirror(project, repo_dir, stash_repo_url,
+                           batched_push=batched_push)
+
+
+def mirror_repository(project, stash_repo_url, metrics, cache_dir=None,
+                      check_refs=False, batched_push=None):
+    '''
+    Mirror a GitLab repository to Stash.
+
+    :param metrics: :class:`metrics.Metrics` to record how long each step took
+                    and how big the repository is in.
+    :param cache_dir: Directory to keep bare mirrors in between runs. If None,
+                      the repository is cloned to a temporary directory that
+                      is deleted afterwards.
+    :param check_refs: Compare the refs on GitLab and Stash first, and skip
+                       the transfer if they are identical.
+    :param batched_push: :class:`BatchedPush` to push a large repository
+                         with, or None to push everything at once.
+    :returns: ``'transferred'`` if the repository was pushed to Stash,
+              ``'empty'`` if it has no commits, ``'clone_failed'`` if it
+              could not be cloned from GitLab, ``'push_failed'`` if it
+              could not be pushed to Stash, or ``'unchanged'`` if
+              ``check_refs`` found nothing to transfer.
+    '''
+    repo = {'name': project['name_with_namespace'],
+            'large': batched_push is not None}
+    unchanged = False
+    if check_refs:
+        with metrics.timer('ref_check', item=repo):
+            unchanged = repos_match(project['ssh_url_to_repo'],
+                                    stash_repo_url)
+    if unchanged:
+        print('Repository "%s" is unchanged, so skipping transfer.' %
+              project['name_with_namespace'], file=sys.stderr)
+        result = 'unchanged'
+    elif cache_dir is None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            result = transfer_mirror(project, temp_dir, stash_repo_url,
+                                     metrics, repo, batched_push)
+    else:
+        repo_dir = os.path.join(cache_dir, '{}.git'.format(project['id']))
+        result = transfer_mirror(project, repo_dir, stash_repo_url, metrics,
+                                 repo, batched_push)
+        if result != 'clone_failed':
+            # Mark the mirror as recently used for evict_mirror_cache
+            os.utime(repo_dir)
+    repo['result'] = result
+    metrics.record(**repo)
+    return result
+
+
+def dir_size(path):
+    ''' Total size in bytes of all the files under ``path``. '''
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+def evict_mirror_cache(cache_dir, max_age=None, max_size=None):
+    '''
+    Delete cached mirrors that have not been used in ``max_age`` days, and
+    then the least recently used ones until the cache takes up at most
+    ``max_size`` bytes.
+
+    :returns: The number of mirrors deleted.
+    '''
+    mirrors = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and entry.name.endswith('.git'):
+            mirrors.append((entry.stat().st_mtime, entry.path))
+    mirrors.sort()
+    evicted = 0
+    if max_age is not None:
+        cutoff = time.time() - max_age * 24 * 60 * 60
+        while mirrors and mirrors[0][0] < cutoff:
+            shutil.rmtree(mirrors.pop(0)[1])
+            evicted += 1
+    if max_size is not None:
+        sizes = [dir_size(path) for _, path in mirrors]
+        total_size = sum(sizes)
+        while mirrors and total_size > max_size:
+            shutil.rmtree(mirrors.pop(0)[1])
+            total_size -= sizes.pop(0)
+            evicted += 1
+    return evicted
 
 
 def main(argv=None):
@@ -63,6 +517,65 @@ def main(argv=None):
                         help='The full URL to your GitLab instance.')
     parser.add_argument('stash_url',
                         help='The full URL to your Stash instance.')
+    parser.add_argument('--catalog',
+                        help='SQLite file to save the list of GitLab \
+                              projects in, so that later runs of this script \
+                              or dump_gitlab_json.py within --catalog_ttl do \
+                              not have to retrieve it from GitLab again.')
+    parser.add_argument('--catalog_ttl',
+                        help='How many seconds a saved --catalog can be \
+                              reused for.',
+                        type=float, default=3600)
+    parser.add_argument('-j', '--jobs',
+                        help='Number of repositories to clone from GitLab \
+                              and push to Stash at the same time. Stash \
+                              projects and repositories are still created \
+                              one at a time.',
+                        type=int, default=1)
+    parser.add_argument('--large_repo_jobs',
+                        help='Number of large repositories (see \
+                              --large_repo_size) to transfer at the same \
+                              time. They are transferred separately from \
+                              the rest, so they do not hold them up.',
+                        type=int, default=1)
+    parser.add_argument('--large_repo_size',
+                        help='Repositories larger than this many gigabytes \
+                              (according to GitLab\'s project statistics) are \
+                              pushed to Stash in batches, which are retried \
+                              separately and which a later run resumes \
+                              after. Set to 0 to push every repository this \
+                              way.',
+                        type=float, default=5)
+    parser.add_argument('-M', '--max_connections',
+                        help='Maximum number of simultaneous connections to \
+                              each of GitLab and Stash. Connections are kept \
+                              open and reused.',
+                        type=int, default=10)
+    parser.add_argument('-m', '--mirror_cache',
+                        help='Directory to keep bare mirrors of the GitLab \
+                              repositories in between runs. Later runs only \
+                              fetch refs that changed from GitLab instead of \
+                              cloning every repository again.')
+    parser.add_argument('--mirror_cache_max_age',
+                        help='Delete mirrors from --mirror_cache that have \
+                              not been used in this many days.',
+                        type=float)
+    parser.add_argument('--mirror_cache_max_size',
+                        help='Delete the least recently used mirrors from \
+                              --mirror_cache until it takes up at most this \
+                              many gigabytes.',
+                        type=float)
+    parser.add_argument('--metrics_file',
+                        help='File to save the time spent in each stage, the \
+                              GitLab and Stash request counts, and the clone \
+                              and push times and size of each repository to. \
+                              Written as CSV if the name ends with .csv, and \
+                              as JSON otherwise.')
+    parser.add_argument('--no_ref_check',
+                        help='Always transfer existing repositories, instead \
+                              of first comparing their refs on GitLab and \
+                              Stash and skipping them when they match.',
+                        action='store_true')
     parser.add_argument('-p', '--password',
                         help='The password to use to authenticate if token is \
                               not specified. If password and token are both \
@@ -70,8 +583,31 @@ def main(argv=None):
                               password.')
     parser.add_argument('-P', '--page_size',
                         help='When retrieving result from GitLab, how many \
-                              results should be included in a given page?.',
-                        type=int, default=20)
+                              results should be included in a given page? \
+                              GitLab returns at most {} \
+                              per page.'.format(MAX_PER_PAGE),
+                        type=int, default=MAX_PER_PAGE)
+    parser.add_argument('--push_batch_size',
+                        help='Number of refs of a large repository to push \
+                              at once.',
+                        type=int, default=1000)
+    parser.add_argument('--push_history_step',
+                        help='Number of commits on the default branch of a \
+                              large repository to push at once.',
+                        type=int, default=10000)
+    parser.add_argument('--push_retries',
+                        help='How many times to retry a failed or timed out \
+                              push of a batch of a large repository.',
+                        type=int, default=3)
+    parser.add_argument('--push_timeout',
+                        help='Seconds after which to give up on a push of a \
+                              batch of a large repository.',
+                        type=float, default=3600)
+    parser.add_argument('-R', '--max_retries',
+                        help='How many times to retry a GitLab request that \
+                              failed with a transient error (such as a 429 \
+                              or 502) before giving up.',
+                        type=int, default=5)
     parser.add_argument('-s', '--verify_ssl',
                         help='Enable SSL certificate verification',
                         action='store_true')
@@ -79,6 +615,15 @@ def main(argv=None):
                         help='Do not update existing repositories and just \
                               skip them.',
                         action='store_true')
+    parser.add_argument('-i', '--stash_index',
+                        help='File to save the list of existing Stash \
+                              projects and repositories in, so that later \
+                              runs within --stash_index_ttl do not have to \
+                              retrieve it from Stash again.')
+    parser.add_argument('--stash_index_ttl',
+                        help='How many seconds a saved --stash_index can be \
+                              reused for.',
+                        type=float, default=3600)
     parser.add_argument('-t', '--token',
                         help='The private GitLab API token to use for \
                               authentication. Either this or username and \
@@ -95,7 +640,13 @@ def main(argv=None):
                         version='%(prog)s {0}'.format(__version__))
     args = parser.parse_args(argv)
 
-    args.page_size = max(100, args.page_size)
+    args.page_size = min(max(1, args.page_size), MAX_PER_PAGE)
+    args.jobs = max(1, args.jobs)
+    args.large_repo_jobs = max(1, args.large_repo_jobs)
+    args.push_batch_size = max(1, args.push_batch_size)
+    args.push_history_step = max(1, args.push_history_step)
+    if args.mirror_cache:
+        os.makedirs(args.mirror_cache, exist_ok=True)
 
     # Convert verbose flag to actually logging level
     log_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
@@ -120,64 +671,79 @@ def main(argv=None):
     if git is None:
         git = GitLab(args.gitlab_url, verify_ssl=args.verify_ssl)
         git.login(args.username, args.password)
+    git = GitLabClient(git, max_connections=args.max_connections,
+                       max_retries=args.max_retries)
+    mount_pooled_adapter(stash._client._session, args.max_connections)
+    metrics = Metrics()
+    metrics.instrument_session(stash._client._session, 'stash')
 
-    print('Retrieving existing Stash projects...', end="", file=sys.stderr)
-    sys.stderr.flush()
-    key_set = {proj['key'] for proj in stash.projects}
-    stash_project_names = {proj['name'] for proj in stash.projects}
-    names_to_keys = {proj['name']: proj['key'] for proj in stash.projects}
-    print('done', file=sys.stderr)
-    sys.stderr.flush()
+    stash_index = None
+    if args.stash_index:
+        stash_index = StashIndex.load(args.stash_index, args.stash_index_ttl)
+    if stash_index is None:
+        print('Retrieving existing Stash projects...', end="",
+              file=sys.stderr)
+        sys.stderr.flush()
+        with metrics.timer('stash_crawl'):
+            stash_index = StashIndex.crawl(stash, jobs=args.jobs)
+        if args.stash_index:
+            stash_index.save(args.stash_index)
+        print('done', file=sys.stderr)
+        sys.stderr.flush()
+    else:
+        print('Using saved index of Stash projects from %s' %
+              args.stash_index, file=sys.stderr)
+    key_set = set(stash_index.projects)
     updated_projects = set()
-    repo_to_slugs = {}
     failed_to_clone = set()
-    cwd = os.getcwd()
+    failed_to_push = set()
     transfer_count = 0
     skipped_count = 0
+    unchanged_count = 0
     print('Processing GitLab projects...', file=sys.stderr)
     sys.stderr.flush()
-    for project in gen_all_results(git.getallprojects,
-                                   per_page=args.page_size):
+    progress = ProgressLine('Mirroring repositories',
+                            total=count_projects(git,
+                                                 catalog_path=args.catalog,
+                                                 ttl=args.catalog_ttl))
+    # Stash projects and repositories are created here one at a time, so key
+    # assignment does not depend on timing. Only the clone/push of each
+    # repository is handed off to the pool.
+    # Large repositories get a pool of their own, so a few huge transfers
+    # don't hold up all the others.
+    mirror_pool = ThreadPoolExecutor(args.jobs)
+    large_pool = ThreadPoolExecutor(args.large_repo_jobs)
+    batched_push = BatchedPush(batch_size=args.push_batch_size,
+                               history_step=args.push_history_step,
+                               timeout=args.push_timeout,
+                               retries=args.push_retries)
+    large_repo_size = args.large_repo_size * 1024 ** 3
+    repository_sizes = RepositorySizes(git)
+    mirror_jobs = []
+    for project in list_projects(git, args.page_size,
+                                 catalog_path=args.catalog,
+                                 ttl=args.catalog_ttl):
         print('\n' + ('=' * 80) + '\n', file=sys.stderr)
         sys.stderr.flush()
         proj_name = project['namespace']['name']
         # Create Stash project if it doesn't already exist
-        if proj_name not in stash_project_names:
-            # Create Stash project key
-            key = proj_name
-            if key.islower():
-                key = key.title()
-            key = re.sub(r'[^A-Z]', '', key)
-            if len(key) < 2:
-                key = re.sub(r'[^A-Za-z]', '', proj_name)[0:2].upper()
-            added = False
-            suffix = 65
-            while key in key_set:
-                if not added:
-                    key += 'A'
-                else:
-                    suffix += 1
-                    key = key[:-1] + chr(suffix)
-            key_set.add(key)
+        if proj_name not in stash_index.names_to_keys:
+            # Create Stash project key, the same way JIRA keys are made
+            key = make_project_key(proj_name, key_set)
 
             # Actually add the project to Stash
             print('Creating Stash project "%s" with key %s...' %
                   (proj_name, key), end="", file=sys.stderr)
             sys.stderr.flush()
-            stash.projects.create(key, proj_name)
-            names_to_keys[proj_name] = key
-            stash_project_names.add(proj_name)
+            with metrics.timer('stash_create'):
+                stash.projects.create(key, proj_name)
+            stash_index.add_project(key, proj_name)
             print('done', file=sys.stderr)
             sys.stderr.flush()
         else:
-            key = names_to_keys[proj_name]
-
-        stash_project = stash.projects[key]
+            key = stash_index.names_to_keys[proj_name]
 
-        # Initialize maping from repository names to slugs for later
-        if key not in repo_to_slugs:
-            repo_to_slugs[key] = {repo['name']: repo['slug'] for repo in
-                                  stash_project.repos}
+        stash_repos = stash_index.projects[key]['repos']
 
         # Create Stash-compatible name for repository
         # Repository names are limited to 128 characters.
@@ -191,12 +757,14 @@ def main(argv=None):
             repo_name = repo_name[0:128]
 
         # Add repository to Stash project if it's not already there
-        if repo_name not in repo_to_slugs[key]:
+        if repo_name not in stash_repos:
             print('Creating Stash repository "%s" in project "%s"...' %
                   (repo_name, proj_name), end="", file=sys.stderr)
             sys.stderr.flush()
-            stash_repo = stash_project.repos.create(repo_name)
-            repo_to_slugs[key][repo_name] = stash_repo['slug']
+            with metrics.timer('stash_create'):
+                stash_repo = stash.projects[key].repos.create(repo_name)
+            stash_index.add_repo(key, stash_repo)
+            check_refs = False
             print('done', file=sys.stderr)
             sys.stderr.flush()
         elif args.skip_existing:
@@ -204,69 +772,99 @@ def main(argv=None):
                   (repo_name, proj_name), file=sys.stderr)
             sys.stderr.flush()
             skipped_count += 1
+            progress.update()
             continue
         else:
             print('Updating existing Stash repository "%s" in project "%s"' %
                   (repo_name, proj_name), file=sys.stderr)
             sys.stderr.flush()
-            repo_slug = repo_to_slugs[key][repo_name]
-            stash_repo = stash_project.repos[repo_slug].get()
+            stash_repo = stash_repos[repo_name]
+            check_refs = not args.no_ref_check
 
         for clone_link in stash_repo['links']['clone']:
             if clone_link['name'] == 'ssh':
                 stash_repo_url = clone_link['href']
                 break
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Clone repository to temporary directory
-            print('\nCloning GitLab repository...', file=sys.stderr)
-            sys.stderr.flush()
-            try:
-                subprocess.check_call(['git', 'clone', '--mirror',
-                                       project['ssh_url_to_repo'],
-                                       temp_dir])
-            except subprocess.CalledProcessError:
-                print('Failed to clone GitLab repository. This usually when ' +
-                      'it does not exist.', file=sys.stderr)
-                failed_to_clone.add(project['name_with_namespace'])
-                skipped_count += 1
-                continue
-            os.chdir(temp_dir)
+        repo_size = repository_sizes.get(project)
+        if repo_size is not None and repo_size > large_repo_size:
+            print('Repository "%s" is %.1f GB, so pushing it in batches.' %
+                  (project['name_with_namespace'], repo_size / 1024 ** 3),
+                  file=sys.stderr)
+            mirror_job = large_pool.submit(mirror_repository, project,
+                                           stash_repo_url, metrics,
+                                           cache_dir=args.mirror_cache,
+                                           check_refs=check_refs,
+                                           batched_push=batched_push)
+        else:
+            mirror_job = mirror_pool.submit(mirror_repository, project,
+                                            stash_repo_url, metrics,
+                                            cache_dir=args.mirror_cache,
+                                            check_refs=check_refs)
+        mirror_job.add_done_callback(lambda _: progress.update())
+        mirror_jobs.append((project, proj_name, mirror_job))
 
-            # Check that repository is not empty
-            try:
-                subprocess.check_call(['git', 'log', '--format=oneline', '-1'],
-                                      stdout=subprocess.DEVNULL,
-                                      stderr=subprocess.DEVNULL)
-            except subprocess.CalledProcessError:
-                print('Repository is empty, so skipping push to Stash.',
-                      file=sys.stderr)
+    # Wait for the remaining transfers and tally up the results in the order
+    # the projects were processed.
+    mirror_pool.shutdown()
+    large_pool.shutdown()
+    progress.close()
+    for project, proj_name, mirror_job in mirror_jobs:
+        try:
+            result = mirror_job.result()
+        except Exception:
+            # Don't let one repository cost us the summary and index of all
+            # the others
+            logging.exception('Failed to mirror repository "%s".',
+                              project['name_with_namespace'])
+            result = 'push_failed'
+        if result == 'clone_failed':
+            failed_to_clone.add(project['name_with_namespace'])
+            skipped_count += 1
+        elif result == 'push_failed':
+            failed_to_push.add(project['name_with_namespace'])
+            skipped_count += 1
+        elif result == 'unchanged':
+            unchanged_count += 1
+        else:
+            if result == 'empty':
                 skipped_count += 1
             else:
-                # Change remote to Stash and push
-                print('\nPushing repository to Stash...', file=sys.stderr)
-                sys.stderr.flush()
-                subprocess.check_call(['git', 'remote', 'set-url', 'origin',
-                                       stash_repo_url])
-                subprocess.check_call(['git', 'push', '--mirror'])
                 transfer_count += 1
+            updated_projects.add(proj_name)
 
-            os.chdir(cwd)
-
-        updated_projects.add(proj_name)
+    if args.stash_index:
+        stash_index.save(args.stash_index)
 
+    if args.mirror_cache:
+        max_size = args.mirror_cache_max_size
+        if max_size is not None:
+            max_size *= 1024 ** 3
+        evicted = evict_mirror_cache(args.mirror_cache,
+                                     max_age=args.mirror_cache_max_age,
+                                     max_size=max_size)
+        logging.info('Evicted %d mirrors from the cache.', evicted)
 
     print('\n' + ('=' * 35) + 'SUMMARY' + ('=' * 35), file=sys.stderr)
     print('{} repositories transferred.\n'.format(transfer_count),
           file=sys.stderr)
     print('{} repositories skipped.\n'.format(skipped_count),
           file=sys.stderr)
+    print('{} repositories skipped because they are unchanged.\n'.format(
+        unchanged_count), file=sys.stderr)
     print('Projects created/updated:', file=sys.stderr)
     for proj in sorted(updated_projects):
         print('\t' + proj, file=sys.stderr)
     print('Repositories that we could not clone:', file=sys.stderr)
     for repo_name in sorted(failed_to_clone):
         print('\t' + repo_name, file=sys.stderr)
+    print('Repositories that we could not push:', file=sys.stderr)
+    for repo_name in sorted(failed_to_push):
+        print('\t' + repo_name, file=sys.stderr)
+    git.print_stats()
+    if args.metrics_file:
+        metrics.add_request_stats('gitlab', git.stats)
+        metrics.write(args.metrics_file)
 
 
 if __name__ == '__main__':
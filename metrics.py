@@ -0,0 +1,186 @@
+# License: BSD 3 clause
+'''
+Timers, counters and progress reporting for the migration scripts.
+'''
+
+import cProfile
+import csv
+import json
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+
+class Metrics(object):
+    '''
+    Thread-safe timers and counters for each stage of a run, plus a row of
+    measurements for each item (e.g., project or repository) processed.
+
+    Optionally, the CPU-bound stages are also profiled with cProfile.
+    '''
+
+    def __init__(self, profile_path=None):
+        '''
+        :param profile_path: File to save cProfile statistics for the stages
+                             timed with ``profile=True`` to, or None to not
+                             profile anything.
+        '''
+        self.stages = defaultdict(Counter)
+        self.items = []
+        self.profile_path = profile_path
+        self.profiler = cProfile.Profile() if profile_path else None
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def count(self, stage, **counts):
+        ''' Add ``counts`` to the counters for ``stage``. '''
+        with self._lock:
+            self.stages[stage].update(counts)
+
+    @contextmanager
+    def timer(self, stage, profile=False, item=None):
+        '''
+        Context manager that adds the time spent in it to ``stage``.
+
+        :param profile: Also profile the code in it, if profiling is enabled.
+                        cProfile only sees the thread that enabled it, so this
+                        only works in the main thread.
+        :param item: Dictionary of measurements for a single item to also
+                     save the time to, as ``<stage>_seconds``.
+        '''
+        profiler = None
+        if profile and threading.current_thread() is threading.main_thread():
+            profiler = self.profiler
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+            self.count(stage, calls=1, seconds=seconds)
+            if item is not None:
+                item[stage + '_seconds'] = seconds
+
+    def record(self, **fields):
+        ''' Add a row of measurements for a single item. '''
+        with self._lock:
+            self.items.append(fields)
+
+    def add_request_stats(self, prefix, stats):
+        '''
+        Add the per-endpoint request counters kept by a
+        :class:`gitlab_client.GitLabClient` as stages named
+        ``prefix.endpoint``.
+        '''
+        for endpoint, counts in stats.items():
+            self.count('{}.{}'.format(prefix, endpoint), **counts)
+
+    def instrument_session(self, session, stage):
+        '''
+        Count the requests made with a ``requests.Session``, along with the
+        bytes received and the time they took, under ``stage``.
+        '''
+        def count_response(response, *args, **kwargs):
+            self.count(stage, requests=1, bytes=len(response.content),
+                       seconds=response.elapsed.total_seconds())
+        session.hooks['response'].append(count_response)
+
+    def write(self, path):
+        '''
+        Save everything measured to ``path``, as CSV if its name ends with
+        ``.csv`` and as JSON otherwise.
+        '''
+        with self._lock:
+            stages = {stage: dict(counts) for stage, counts
+                      in sorted(self.stages.items())}
+            items = list(self.items)
+        if path.endswith('.csv'):
+            rows = [dict(counts, type='stage', name=stage)
+                    for stage, counts in stages.items()]
+            rows.extend(dict(item, type='item') for item in items)
+            fields = ['type', 'name']
+            for row in rows:
+                fields.extend(field for field in row if field not in fields)
+            with open(path, 'w', newline='') as metrics_file:
+                writer = csv.DictWriter(metrics_file, fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, 'w') as metrics_file:
+                json.dump({'wall_seconds': time.time() - self.started,
+                           'stages': stages, 'items': items}, metrics_file,
+                          indent=4)
+
+    def close(self, path=None):
+        '''
+        Save the metrics to ``path`` (if given) and the profiling statistics
+        to ``profile_path`` (if profiling).
+        '''
+        if path:
+            self.write(path)
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_path)
+
+
+class ProgressLine(object):
+    '''
+    A status line on stderr with how many items are done, how fast they are
+    going and (if the total is known) how long the rest will take. It is
+    redrawn in place at most every ``interval`` seconds.
+    '''
+
+    def __init__(self, label, total=None, file=None, interval=0.5):
+        '''
+        :param label: What is being done, e.g. ``'Creating project entries'``.
+        :param total: Number of items there are in total, if known.
+        :param file: File to draw the line on. Defaults to ``sys.stderr``.
+        '''
+        self.label = label
+        self.total = total
+        self.file = sys.stderr if file is None else file
+        self.interval = interval
+        self.done = 0
+        self._started = time.monotonic()
+        self._drawn_at = None
+        self._width = 0
+        self._lock = threading.Lock()
+
+    def update(self, done=None):
+        '''
+        Record that one more item is finished, or that ``done`` items are.
+        '''
+        with self._lock:
+            self.done = self.done + 1 if done is None else done
+            now = time.monotonic()
+            if self._drawn_at is None or now - self._drawn_at >= self.interval:
+                self._draw(now)
+
+    def _draw(self, now):
+        elapsed = now - self._started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        if self.total:
+            line = '{}: {}/{} ({:.0%}), {:.1f}/s'.format(
+                self.label, self.done, self.total,
+                min(self.done / self.total, 1), rate)
+            if rate:
+                remaining = max(self.total - self.done, 0) / rate
+                line += ', ETA {}'.format(timedelta(seconds=round(remaining)))
+        else:
+            line = '{}: {}, {:.1f}/s'.format(self.label, self.done, rate)
+        print('\r' + line.ljust(self._width), end='', file=self.file)
+        self.file.flush()
+        self._width = len(line)
+        self._drawn_at = now
+
+    def close(self):
+        ''' Draw the final state of the line and end it. '''
+        with self._lock:
+            self._draw(time.monotonic())
+            print(file=self.file)
+            self.file.flush()
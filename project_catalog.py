@@ -0,0 +1,152 @@
+# License: BSD 3 clause
+'''
+Local catalog of the projects on GitLab shared by the migration scripts, so
+that a full migration only lists the projects once, and the project key
+generation they both use.
+'''
+
+import json
+import logging
+import re
+import sqlite3
+import time
+
+from gitlab_client import gen_all_results
+
+
+class ProjectCatalog(object):
+    '''
+    SQLite database of every GitLab project, in the order GitLab lists them,
+    along with when each was last active and when the catalog was crawled.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path: SQLite database file. Created if it does not exist.
+        '''
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS projects ('
+                                    'position INTEGER PRIMARY KEY, '
+                                    'id INTEGER NOT NULL, '
+                                    'last_activity_at TEXT, '
+                                    'project TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS crawls ('
+                                    'finished_at REAL NOT NULL)')
+
+    @property
+    def crawled_at(self):
+        '''
+        Time (in seconds since the epoch) the last complete crawl finished, or
+        None if GitLab was never crawled.
+        '''
+        return self.connection.execute(
+            'SELECT MAX(finished_at) FROM crawls').fetchone()[0]
+
+    def is_fresh(self, ttl):
+        '''
+        :returns: Whether GitLab was crawled in the last ``ttl`` seconds.
+        '''
+        crawled_at = self.crawled_at
+        return crawled_at is not None and time.time() - crawled_at <= ttl
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM projects').fetchone()[0]
+
+    def projects(self):
+        ''' Generate the projects saved by the last crawl, in order. '''
+        for row in self.connection.execute(
+                'SELECT project FROM projects ORDER BY position'):
+            yield json.loads(row[0])
+
+    def crawl(self, git, page_size):
+        '''
+        Generate every project on GitLab (including their statistics, if
+        GitLab provides them) while replacing the catalog with them.
+
+        The new catalog is only committed once all projects have been listed,
+        so an interrupted crawl leaves the previous one in place.
+        '''
+        self.connection.execute('DELETE FROM projects')
+        for position, project in enumerate(gen_all_results(git.getprojectsall,
+                                                           per_page=page_size,
+                                                           statistics=True)):
+            self.connection.execute(
+                'INSERT INTO projects VALUES (?, ?, ?, ?)',
+                (position, project['id'], project.get('last_activity_at'),
+                 json.dumps(project)))
+            yield project
+        self.connection.execute('DELETE FROM crawls')
+        self.connection.execute('INSERT INTO crawls VALUES (?)',
+                                (time.time(),))
+        self.connection.commit()
+
+    def close(self):
+        ''' Close the database, discarding an unfinished crawl. '''
+        self.connection.close()
+
+
+def list_projects(git, page_size, catalog_path=None, ttl=60 * 60):
+    '''
+    Generate every project on GitLab, in the order GitLab lists them.
+
+    :param catalog_path: :class:`ProjectCatalog` to read the projects from if
+                         it was crawled in the last ``ttl`` seconds, or to
+                         save them to otherwise. If None, GitLab is always
+                         crawled.
+    '''
+    if catalog_path is None:
+        yield from gen_all_results(git.getprojectsall, per_page=page_size,
+                                   statistics=True)
+        return
+    catalog = ProjectCatalog(catalog_path)
+    try:
+        if catalog.is_fresh(ttl):
+            logging.info('Using the %d GitLab projects saved in %s.',
+                         len(catalog), catalog_path)
+            yield from catalog.projects()
+        else:
+            yield from catalog.crawl(git, page_size)
+    finally:
+        catalog.close()
+
+
+def count_projects(git, catalog_path=None, ttl=60 * 60):
+    '''
+    :returns: How many projects :func:`list_projects` will generate with the
+              same arguments, or None if GitLab does not say. A fresh catalog
+              is counted without asking GitLab, so that using it makes no
+              project listing requests at all.
+    '''
+    if catalog_path is not None:
+        catalog = ProjectCatalog(catalog_path)
+        try:
+            if catalog.is_fresh(ttl):
+                return len(catalog)
+        finally:
+            catalog.close()
+    return getattr(git.getprojectsall(per_page=1), 'total', None)
+
+
+def make_project_key(name, key_set):
+    '''
+    Create a JIRA or Stash project key for a project name that is not already
+    in ``key_set``, and add it to the set.
+    '''
+    key = name
+    if key.islower():
+        key = key.title()
+    key = re.sub(r'[^A-Z]', '', key)
+    if len(key) < 2:
+        key = re.sub(r'[^A-Za-z]', '', name)[0:2].upper()
+    added = False
+    suffix = 65
+    while key in key_set:
+        if not added:
+            key += 'A'
+        else:
+            suffix += 1
+            key = key[:-1] + chr(suffix)
+    key_set.add(key)
+    return key
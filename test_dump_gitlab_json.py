@@ -0,0 +1,227 @@
+# License: BSD 3 clause
+'''
+Regression tests for the parts of dump_gitlab_json.py whose output must not
+change.
+
+Run them with ``python -m unittest`` from the root of the repository.
+'''
+
+import json
+import os
+import random
+import re
+import tempfile
+import unittest
+from datetime import datetime
+from io import StringIO
+
+from dump_gitlab_json import (JiraJSONWriter, ShardWriter, md_to_wiki,
+                              merge_shards)
+from metrics import Metrics, ProgressLine
+from project_catalog import make_project_key
+
+
+def line_by_line_md_to_wiki(md_string):
+    '''
+    The original line-by-line md_to_wiki, which :func:`md_to_wiki` must match
+    outside of code blocks.
+    '''
+    output_buf = StringIO()
+    if md_string is not None:
+        for line in md_string.splitlines():
+            # Code blocks
+            line = re.sub(r'```([a-z]+)$', r'{code:\1}', line)
+            line = re.sub(r'```$', r'{code}', line)
+            # Emoji
+            line = line.replace(':+1:', '(y)')
+            line = line.replace(':-1:', '(n)')
+            # Hyperlinks
+            line = re.sub(r'\[([^\]]+)\]\(([^\)]+)\)', r'[\1|\2]', line)
+            # Usernames
+            line = re.sub(r'@([a-zA-Z0-9]+)(\b|_$)', r'[~\1]\2', line)
+            print(line, file=output_buf)
+    else:
+        print('', file=output_buf)
+    return output_buf.getvalue()
+
+
+# Pieces that random Markdown documents are built from, without code fences
+MARKDOWN_TOKENS = ['@bob', '@a1', '_', ' ', '[', ']', '(', ')', 'x', ':+1:',
+                   ':-1:', '\n', '\r\n', '\r', '@', 'http://x', '|', '{', 'é',
+                   '.', '\x0b']
+
+
+class TestMarkdownToWiki(unittest.TestCase):
+
+    def assert_same_as_line_by_line(self, md_string):
+        self.assertEqual(md_to_wiki(md_string),
+                         line_by_line_md_to_wiki(md_string),
+                         msg=repr(md_string))
+
+    def test_samples_match_line_by_line(self):
+        for md_string in [None, '', '\n', 'plain text',
+                          'Thanks @bob :+1:\nbut not @alice :-1:',
+                          'See [the docs](http://example.com/docs).',
+                          'Two [a](b) links [c](d) on a line',
+                          '@bob_\n@a.b\nemail@example.com',
+                          'Unclosed [link(http://x)',
+                          '[multi\nline](link)',
+                          'Windows\r\nline\rendings\n',
+                          'Trailing newlines\n\n\n']:
+            self.assert_same_as_line_by_line(md_string)
+
+    def test_random_documents_match_line_by_line(self):
+        rnd = random.Random(0)
+        for _ in range(20000):
+            md_string = ''.join(rnd.choice(MARKDOWN_TOKENS)
+                                for _ in range(rnd.randint(0, 14)))
+            self.assert_same_as_line_by_line(md_string)
+
+    def test_link_with_username(self):
+        md_string = 'See [@bob](http://x/@bob) and @alice_'
+        self.assertEqual(md_to_wiki(md_string),
+                         'See [[~bob]|http://x/[~bob]] and [~alice]_\n')
+        self.assert_same_as_line_by_line(md_string)
+
+    def test_fenced_code_is_not_converted(self):
+        self.assertEqual(
+            md_to_wiki('```python\n@bob [a](b)\n```\n@bob [x](y)\n'),
+            '{code:python}\n@bob [a](b)\n{code}\n[~bob] [x|y]\n')
+
+    def test_consecutive_code_blocks(self):
+        self.assertEqual(md_to_wiki('```\ncode\n```\n```ruby\n@x\n```'),
+                         '{code}\ncode\n{code}\n{code:ruby}\n@x\n{code}\n')
+
+    def test_unclosed_fence_runs_to_the_end(self):
+        self.assertEqual(md_to_wiki('text @bob\n```\n@bob [a](b)\nmore'),
+                         'text [~bob]\n{code}\n@bob [a](b)\nmore\n')
+
+    def test_links_to_attached_files(self):
+        attached = frozenset(['/uploads/abc/a.png', '/uploads/d/my%20f.txt'])
+        self.assertEqual(
+            md_to_wiki('![i](/uploads/abc/a.png) [f](/uploads/d/my%20f.txt) '
+                       '![x](/uploads/e/b.png)\n```\n![i](/uploads/abc/a.png)'
+                       '\n```', attached),
+            '!a.png! [^my f.txt] ![x|/uploads/e/b.png]\n'
+            '{code}\n![i](/uploads/abc/a.png)\n{code}\n')
+
+    def test_fence_on_the_last_line(self):
+        for md_string in ['@bob\n```', '[a](b)\n```python']:
+            self.assert_same_as_line_by_line(md_string)
+
+
+class TestJiraJSONWriter(unittest.TestCase):
+
+    PROJECT = {'name': 'Project', 'key': 'PR', 'description': 'Line\nbreak',
+               'issues': [{'summary': 'é "quoted"', 'labels': [],
+                           'comments': [{'body': '[~bob]'}], 'extra': {}}]}
+    USER = {'name': 'bob', 'fullname': 'Bob', 'active': True, 'groups': []}
+
+    def write(self, projects, users, indent):
+        output = StringIO()
+        writer = JiraJSONWriter(output, indent=indent)
+        for project in projects:
+            writer.write_project(project)
+        for user in users:
+            writer.write_user(user)
+        writer.close()
+        return output.getvalue()
+
+    def assert_same_as_dump(self, projects, users):
+        # The whole export used to be built in a defaultdict(list), so lists
+        # that nothing was added to were left out
+        document = {}
+        if projects:
+            document['projects'] = projects
+        if users:
+            document['users'] = users
+        self.assertEqual(self.write(projects, users, 4),
+                         json.dumps(document, indent=4) + '\n')
+        self.assertEqual(self.write(projects, users, None),
+                         json.dumps(document, separators=(',', ':')) + '\n')
+
+    def test_projects_and_users(self):
+        self.assert_same_as_dump([self.PROJECT, dict(self.PROJECT, key='P2')],
+                                 [self.USER, dict(self.USER, name='alice')])
+
+    def test_single_project_and_user(self):
+        self.assert_same_as_dump([self.PROJECT], [self.USER])
+
+    def test_only_projects(self):
+        self.assert_same_as_dump([self.PROJECT], [])
+
+    def test_only_users(self):
+        self.assert_same_as_dump([], [self.USER])
+
+    def test_empty(self):
+        self.assert_same_as_dump([], [])
+
+
+class ListWriter(object):
+    ''' Collects the projects written by :func:`merge_shards`. '''
+
+    def __init__(self):
+        self.projects = []
+
+    def write_project(self, jira_project):
+        self.projects.append(jira_project)
+
+
+class TestMergeShards(unittest.TestCase):
+
+    # Project names in GitLab's listing order. Several of them make the same
+    # key, so the keys depend on the order they are assigned in.
+    NAMES = ['Project', 'Program', 'alpha', 'Prism', 'Alpha Beta', 'project',
+             'Pr', 'AB', 'xy', 'Production']
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def write_shards(self, num_shards, finished=True):
+        paths = []
+        for index in range(num_shards):
+            path = os.path.join(self.temp_dir.name,
+                                'shard{}.jsonl'.format(index))
+            with open(path, 'w') as shard_file:
+                writer = ShardWriter(shard_file, (index, num_shards))
+                for position, name in enumerate(self.NAMES):
+                    if position % num_shards == index:
+                        writer.write_project(position, name,
+                                             {'name': name, 'issues': []})
+                if finished or index:
+                    writer.close({'user{}'.format(index): index},
+                                 datetime(2016, 1, index + 1))
+            paths.append(path)
+        return paths
+
+    def merge(self, paths):
+        writer = ListWriter()
+        mentioned_users = {}
+        run_started = merge_shards(paths, writer, mentioned_users, Metrics(),
+                                   ProgressLine('Merging', file=StringIO()))
+        return writer.projects, mentioned_users, run_started
+
+    def test_keys_match_a_single_pass(self):
+        key_set = set()
+        expected = [(name, make_project_key(name, key_set))
+                    for name in self.NAMES]
+        for num_shards in (1, 2, 3):
+            # The order the shard files are given in doesn't matter either
+            paths = self.write_shards(num_shards)[::-1]
+            projects, mentioned_users, run_started = self.merge(paths)
+            self.assertEqual([(project['name'], project['key'])
+                              for project in projects], expected)
+            self.assertEqual(mentioned_users,
+                             {'user{}'.format(index): index
+                              for index in range(num_shards)})
+            self.assertEqual(run_started, datetime(2016, 1, 1))
+
+    def test_incomplete_shard_raises(self):
+        paths = self.write_shards(3, finished=False)
+        with self.assertRaises(ValueError):
+            self.merge(paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
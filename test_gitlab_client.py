@@ -0,0 +1,175 @@
+# License: BSD 3 clause
+'''
+Tests for telling failed GitLab requests apart from the end of the results.
+
+Run them with ``python -m unittest`` from the root of the repository.
+'''
+
+import io
+import json
+import random
+import time
+import unittest
+
+import requests
+
+from gitlab_client import GitLabAPIError, GitLabClient, Page, gen_all_results
+
+
+def make_response(status_code, body=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = 'Reason'
+    response._content = json.dumps(body).encode('utf-8')
+    response.raw = io.BytesIO()
+    response.headers.update(headers or {})
+    return response
+
+
+class StubSession(object):
+    '''
+    Stands in for ``requests.Session``, answering each request with the next
+    response (or raising the next exception) in a list.
+    '''
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class StubGitLab(object):
+    api_url = 'http://gitlab.example.com/api/v3'
+    headers = {'PRIVATE-TOKEN': 'token', 'connection': 'close'}
+    verify_ssl = True
+
+
+def make_client(responses, max_retries=3):
+    client = GitLabClient(StubGitLab(), max_connections=2,
+                          max_retries=max_retries, backoff=0.001)
+    client.session = StubSession(responses)
+    return client
+
+
+class TestRequest(unittest.TestCase):
+
+    def test_only_auth_header_is_copied(self):
+        client = GitLabClient(StubGitLab())
+        self.assertEqual(client.session.headers['PRIVATE-TOKEN'], 'token')
+        self.assertNotEqual(client.session.headers.get('connection'), 'close')
+
+    def test_success(self):
+        client = make_client([make_response(200, {'id': 1})])
+        self.assertEqual(client.getproject(1), {'id': 1})
+
+    def test_rejected_request_returns_false(self):
+        client = make_client([make_response(404)])
+        self.assertIs(client.getproject(1), False)
+        self.assertEqual(client.session.calls, 1)
+
+    def test_auth_failures_raise(self):
+        for status_code in (401, 403):
+            client = make_client([make_response(status_code)])
+            with self.assertRaises(GitLabAPIError):
+                client.getproject(1)
+            self.assertEqual(client.session.calls, 1)
+
+    def test_retries_stop_at_max_retries(self):
+        client = make_client([make_response(503)] * 10, max_retries=3)
+        with self.assertRaises(GitLabAPIError):
+            client.getproject(1)
+        self.assertEqual(client.session.calls, 4)
+        self.assertEqual(client.stats['getproject']['retries'], 3)
+        self.assertEqual(client.stats['getproject']['failures'], 1)
+
+    def test_request_errors_are_retried_and_release_their_slot(self):
+        errors = [requests.exceptions.ChunkedEncodingError('truncated'),
+                  requests.exceptions.ContentDecodingError('garbled'),
+                  requests.ConnectionError('reset')]
+        client = make_client(errors + [make_response(200, {'id': 1})])
+        self.assertEqual(client.getproject(1), {'id': 1})
+        self.assertEqual(client.stats['getproject']['retries'], 3)
+        self.assertEqual(client.rate_limiter._in_flight, 0)
+
+    def test_throttled_request_waits_for_retry_after(self):
+        throttled = make_response(429, headers={'Retry-After': '0.05'})
+        client = make_client([throttled, make_response(200, {'id': 1})])
+        start = time.monotonic()
+        self.assertEqual(client.getproject(1), {'id': 1})
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(client.stats['getproject']['throttled'], 1)
+
+    def test_listing_keeps_pagination_headers(self):
+        client = make_client([make_response(200, [{'id': 1}],
+                                            headers={'X-Total': '3',
+                                                     'X-Total-Pages': '2'})])
+        page = client.getprojectsall()
+        self.assertEqual(page, [{'id': 1}])
+        self.assertEqual((page.total, page.total_pages), (3, 2))
+
+
+class StubListing(object):
+    '''
+    Stands in for a pyapi-gitlab listing method, returning the given pages.
+    '''
+
+    def __init__(self, pages, delay=0):
+        self.pages = pages
+        self.delay = delay
+        self.requested = []
+
+    def __call__(self, page=1, per_page=20):
+        self.requested.append(page)
+        if self.delay:
+            # Make later pages finish in a different order than requested
+            time.sleep(random.uniform(0, self.delay))
+        return self.pages.get(page, [])
+
+
+class TestGenAllResults(unittest.TestCase):
+
+    def test_short_page_ends_listing(self):
+        listing = StubListing({1: [1, 2], 2: [3]})
+        self.assertEqual(list(gen_all_results(listing, per_page=2)),
+                         [1, 2, 3])
+
+    def test_empty_page_ends_listing(self):
+        listing = StubListing({1: [1, 2], 2: []})
+        self.assertEqual(list(gen_all_results(listing, per_page=2)), [1, 2])
+
+    def test_rejected_first_page_is_empty(self):
+        listing = StubListing({1: False})
+        self.assertEqual(list(gen_all_results(listing, per_page=2)), [])
+
+    def test_rejected_later_page_raises(self):
+        listing = StubListing({1: [1, 2], 2: False, 3: [5]})
+        with self.assertRaises(GitLabAPIError):
+            list(gen_all_results(listing, per_page=2))
+
+    def test_rejected_later_page_raises_with_page_count(self):
+        listing = StubListing({1: Page([1, 2], 5, 3), 2: False,
+                               3: Page([5], 5, 3)})
+        with self.assertRaises(GitLabAPIError):
+            list(gen_all_results(listing, per_page=2))
+
+    def test_pages_are_yielded_in_order_with_page_count(self):
+        num_pages = 20
+        pages = {page: Page([page * 10, page * 10 + 1], num_pages * 2,
+                            num_pages)
+                 for page in range(1, num_pages + 1)}
+        listing = StubListing(pages, delay=0.01)
+        self.assertEqual(list(gen_all_results(listing, per_page=2)),
+                         [item for page in range(1, num_pages + 1)
+                          for item in pages[page]])
+        self.assertEqual(sorted(listing.requested),
+                         list(range(1, num_pages + 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()